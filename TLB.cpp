@@ -22,16 +22,17 @@ MM *  __attribute__ ((noinline))  miss(MM * start, uint64_t count)  {
     return start;
 }
 
-template<size_t BYTES>
+template<size_t BYTES, bool HUGE_PAGES=false>
 uint64_t* TLB(uint64_t * data, uint64_t size, uint64_t arg1) {
     struct MM<BYTES> * array = NULL;
-    int r =  posix_memalign(reinterpret_cast<void**>(&array), 4096, size);
+    // Huge pages need 2MB alignment.
+    int r =  posix_memalign(reinterpret_cast<void**>(&array), HUGE_PAGES ? 2*1024*1024 : 4096, size);
 	if (r == -1) { 
 		std::cerr << "posix_memalign() failed.  Exiting: " << strerror(errno) << "\n";
 		exit(1);
     }
 
-    r = madvise(reinterpret_cast<void*>(array), size, MADV_NOHUGEPAGE);
+    r = madvise(reinterpret_cast<void*>(array), size, HUGE_PAGES ? MADV_HUGEPAGE : MADV_NOHUGEPAGE);
 	if (r == -1) { 
 		std::cerr << "madvise() failed.  Exiting: " << strerror(errno) << "\n";
 		exit(1);
@@ -64,27 +65,50 @@ uint64_t* TLB_8(uint64_t * data, uint64_t size, uint64_t arg1) {
         return TLB<8>(data, size, arg1);
 }
 
-FUNCTION(one_array_1arg, TLB_8);
+FUNCTION(raw_bytes_1arg, TLB_8);
 
 extern "C"
 uint64_t* TLB_4096(uint64_t * data, uint64_t size, uint64_t arg1) {
         return TLB<4096>(data, size, arg1);
 }
 
-FUNCTION(one_array_1arg, TLB_4096);
+FUNCTION(raw_bytes_1arg, TLB_4096);
 
 extern "C"
 uint64_t* TLB_4160(uint64_t * data, uint64_t size, uint64_t arg1) {
         return TLB<4160>(data, size, arg1);
 }
 
-FUNCTION(one_array_1arg, TLB_4160);
+FUNCTION(raw_bytes_1arg, TLB_4160);
 
 extern "C"
 uint64_t* TLB_2M(uint64_t * data, uint64_t size, uint64_t arg1) {
         return TLB<2*1024*1024 + 64>(data, size, arg1);
 }
 
-FUNCTION(one_array_1arg, TLB_2M);
+FUNCTION(raw_bytes_1arg, TLB_2M);
+
+// The same, but asking for transparent huge pages.
+
+extern "C"
+uint64_t* TLB_4096_huge(uint64_t * data, uint64_t size, uint64_t arg1) {
+        return TLB<4096, true>(data, size, arg1);
+}
+
+FUNCTION(raw_bytes_1arg, TLB_4096_huge);
+
+extern "C"
+uint64_t* TLB_4160_huge(uint64_t * data, uint64_t size, uint64_t arg1) {
+        return TLB<4160, true>(data, size, arg1);
+}
+
+FUNCTION(raw_bytes_1arg, TLB_4160_huge);
+
+extern "C"
+uint64_t* TLB_2M_huge(uint64_t * data, uint64_t size, uint64_t arg1) {
+        return TLB<2*1024*1024 + 64, true>(data, size, arg1);
+}
+
+FUNCTION(raw_bytes_1arg, TLB_2M_huge);
 
 //-O3
\ No newline at end of file
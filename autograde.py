@@ -7,23 +7,188 @@ import re
 #from csvtools import qcsv
 #from CSE142L.jextract import extract as qjson
 #from notebook import render_csv
+import numpy as np
 import pandas as pd
+from spans import span, timed
 
         
-def compute_scores(df, FOM, targets):
-    (base_FOM, target_S) = zip(*targets)
-    
-    df = df.copy()
+# The configurations we grade and what we expect on each.  Rows are matched
+# to benchmark results by score_keys, so order doesn't matter.  If the run
+# includes reps of reference_function for the same configuration, the
+# reference time is measured from those; reference_ET is the fallback.
+score_keys = ["function", "customers", "products", "brands"]
+default_targets = pd.DataFrame([dict(function="join_solution_c", customers=2048, products=4096, brands=64,
+                                     reference_function="join_reference_c", reference_ET=0.017, target_speedup=2.0)])
+
+def make_labels(df):
+    label = df["function"].astype(str)
+    for k in score_keys[1:]:
+        label = label + " " + df[k].astype(str)
+    return label
+
+def robust_statistic(x, statistic="median", trim=0.1):
+    # Reduce the last axis of x.
+    x = np.asarray(x, dtype=float)
+    if statistic == "median":
+        return np.median(x, axis=-1)
+    elif statistic == "trimmed_mean":
+        x = np.sort(x, axis=-1)
+        n = x.shape[-1]
+        k = int(n*trim)
+        return x[..., k:n-k].mean(axis=-1)
+    elif statistic == "mean":
+        return x.mean(axis=-1)
+    else:
+        raise ValueError(f"Unknown statistic '{statistic}'.  Use 'median', 'trimmed_mean', or 'mean'.")
+
+def _padded_statistic(x, n, statistic="median", trim=0.1):
+    # robust_statistic() of the first n[...] values along the last axis of
+    # x, which is padded with NaN past them.
+    x = np.sort(x, axis=-1)  # NaNs sort to the end.
+    n = np.asarray(n)[..., None]
+    if statistic == "median":
+        lo = np.take_along_axis(x, (n - 1)//2, axis=-1)
+        hi = np.take_along_axis(x, n//2, axis=-1)
+        return ((lo + hi)/2)[..., 0]
+    elif statistic in ("trimmed_mean", "mean"):
+        k = (n*trim).astype(int) if statistic == "trimmed_mean" else np.zeros_like(n)
+        pos = np.arange(x.shape[-1])
+        keep = (pos >= k) & (pos < n - k)
+        return (np.where(keep, x, 0.0).sum(axis=-1)/(n - 2*k)[..., 0])
+    else:
+        raise ValueError(f"Unknown statistic '{statistic}'.  Use 'median', 'trimmed_mean', or 'mean'.")
+
+def bootstrap_speedups(reference, ref_n, measured, meas_n, statistic="median", confidence=0.95, resamples=2000, seed=0,
+                       max_elements=2**22):
+    # bootstrap_speedup() for many groups at once.  reference and measured
+    # are NaN-padded (groups, reps) arrays with ref_n and meas_n real reps
+    # per group.  The resamples of a block of groups are drawn and reduced
+    # as one (groups, resamples, reps) array; blocks are kept to about
+    # max_elements values.  Returns arrays of speedup, low and high; with
+    # confidence=None, only the speedups are computed and low and high are
+    # NaN.
+    rng = np.random.default_rng(seed)
+    reference = np.asarray(reference, dtype=float)
+    measured = np.asarray(measured, dtype=float)
+    ref_n = np.asarray(ref_n)
+    meas_n = np.asarray(meas_n)
+    speedup = _padded_statistic(reference, ref_n, statistic)/_padded_statistic(measured, meas_n, statistic)
+    low = np.full(len(speedup), np.nan)
+    high = np.full(len(speedup), np.nan)
+    if confidence is None:
+        return speedup, low, high
+
+    def resample(x, n, rows):
+        # resamples draws, with replacement, from each of the rows.
+        width = x.shape[1]
+        n = n[rows, None, None]
+        shape = (len(rows), resamples, width)
+        if x.size < 2**32 and width < 2**8:
+            # 16 random bits are plenty to pick one of fewer than 256 reps,
+            # and much cheaper to draw than floats.
+            idx = np.multiply(rng.integers(0, 1 << 16, shape, dtype=np.uint16), n.astype(np.uint32), dtype=np.uint32)
+            idx >>= 16
+            idx += (rows*width).astype(np.uint32)[:, None, None]
+        else:
+            idx = (rng.random(shape)*n).astype(np.intp) + (rows*width)[:, None, None]
+        r = x.ravel()[idx]
+        if (n < width).any():
+            r[np.broadcast_to(np.arange(width) >= n, r.shape)] = np.nan
+        return r
+
+    block = max(1, max_elements//(resamples*max(reference.shape[1], measured.shape[1])))
+    for s in range(0, len(speedup), block):
+        rows = np.arange(s, min(s + block, len(speedup)))
+        r = _padded_statistic(resample(reference, ref_n, rows), ref_n[rows, None], statistic)
+        m = _padded_statistic(resample(measured, meas_n, rows), meas_n[rows, None], statistic)
+        low[rows], high[rows] = np.quantile(r/m, [(1 - confidence)/2, (1 + confidence)/2], axis=1)
+    return speedup, low, high
+
+def bootstrap_speedup(reference, measured, statistic="median", confidence=0.95, resamples=2000, seed=0):
+    # Speedup of `measured` over `reference` (both arrays of reps) and its
+    # percentile-bootstrap confidence interval.
+    reference = np.asarray(reference, dtype=float)
+    measured = np.asarray(measured, dtype=float)
+    speedup, low, high = bootstrap_speedups(reference[None, :], [len(reference)], measured[None, :], [len(measured)],
+                                            statistic=statistic, confidence=confidence, resamples=resamples, seed=seed)
+    return speedup[0], low[0], high[0]
+
+def compute_scores(df, FOM, targets, statistic="median", confidence=0.95, resamples=2000):
     baseFOM='reference'+"_"+FOM
-    df = df.loc[(df["function"] == "join_solution_c")].copy().reset_index()
-    df['target_speedup'] = target_S
-    df[baseFOM] = base_FOM
-    df['speedup'] = df[baseFOM]/df[FOM]
-    df['bench_score'] = df['speedup']/df['target_speedup'] * 100.0
-    
-    return df[['label',
-               'customers', 'products', 'brands',
-               'target_speedup', baseFOM, FOM, 'speedup', 'bench_score']]
+    if not isinstance(targets, pd.DataFrame):
+        # Old style: a list of (baseline FOM, target speedup), one per
+        # join_solution_c configuration, in order.
+        (base_FOM, target_S) = zip(*targets)
+        t = df.loc[(df["function"] == "join_solution_c"), score_keys].drop_duplicates().copy()
+        t[baseFOM] = base_FOM
+        t['target_speedup'] = target_S
+        targets = t
+
+    df = df.copy()
+    if 'label' not in df.columns:
+        df['label'] = make_labels(df)
+    ids = [c for c in ['submission'] if c in df.columns]
+    keys = [k for k in score_keys if k in df.columns and k in targets.columns]
+    extra = [c for c in ['reference_function'] if c in targets.columns]
+    columns = ids + ['label', 'customers', 'products', 'brands', 'target_speedup', baseFOM, FOM,
+                     'reps', 'measured_reference', 'speedup', 'speedup_low', 'speedup_high']
+
+    # All the reps of every (submission, function, configuration), as rows
+    # of a NaN-padded array.
+    g = df.groupby(ids + keys, sort=False)
+    df['_group'] = g.ngroup()
+    df['_rep'] = g.cumcount()
+    info = ['label'] + [c for c in ['customers', 'products', 'brands'] if c not in keys]
+    groups = df.drop_duplicates('_group').sort_values('_group')[ids + keys + info + ['_group']]
+    counts = g.size().to_numpy()
+    samples = np.full((len(groups), max(counts.max(initial=0), 1)), np.nan)
+    samples[df['_group'], df['_rep']] = df[FOM].to_numpy(dtype=float)
+
+    graded = groups.merge(targets[keys + extra + [baseFOM, 'target_speedup']], on=keys, how="inner")
+    if graded.empty:
+        scores = pd.DataFrame(columns=columns)
+        scores['bench_score'] = pd.Series(dtype=float)
+        return scores
+
+    # The group holding each graded group's reference_function reps, if any.
+    ref_group = np.full(len(graded), -1)
+    if extra:
+        wanted = graded[ids + keys].assign(function=graded['reference_function'])
+        found = wanted.merge(groups[ids + keys + ['_group']], on=ids + keys, how="left")['_group']
+        ref_group = found.fillna(-1).astype(int).to_numpy()
+    measured_reference = ref_group >= 0
+
+    # Groups without reference reps use reference_FOM as their only rep.
+    reference = np.full((len(graded), samples.shape[1]), np.nan)
+    reference[measured_reference] = samples[ref_group[measured_reference]]
+    reference[~measured_reference, 0] = graded[baseFOM].to_numpy(dtype=float)[~measured_reference]
+    ref_n = np.where(measured_reference, counts[np.maximum(ref_group, 0)], 1)
+    measured = samples[graded['_group']]
+    meas_n = counts[graded['_group']]
+
+    speedup, low, high = bootstrap_speedups(reference, ref_n, measured, meas_n, statistic=statistic,
+                                            confidence=confidence, resamples=resamples)
+    scores = graded[ids + ['label', 'customers', 'products', 'brands', 'target_speedup']].copy()
+    scores[baseFOM] = _padded_statistic(reference, ref_n, statistic)
+    scores[FOM] = _padded_statistic(measured, meas_n, statistic)
+    scores['reps'] = meas_n
+    scores['measured_reference'] = measured_reference
+    scores['speedup'] = speedup
+    scores['speedup_low'] = low
+    scores['speedup_high'] = high
+    scores = scores[columns].reset_index(drop=True)
+    scores['bench_score'] = scores['speedup']/scores['target_speedup'] * 100.0
+    return scores
+
+def finalize_scores(scores, by=None):
+    # Each configuration is worth an equal share of 100 points (per
+    # submission, if `by` is given), capped at that share.
+    scores = scores.copy()
+    count = scores.groupby(by)['label'].transform('size') if by else max(len(scores), 1)
+    scores['max_score'] = 100.0/count
+    scores['score'] = (scores['bench_score']/count).round(2)
+    scores['capped_score'] = scores['score'].clip(upper=scores['max_score'])
+    return scores
 
 def compute_correctness(dir=None):
     if dir == None:
@@ -37,32 +202,67 @@ def compute_correctness(dir=None):
     corrects = results["correctness"].sum()
     return corrects
 
-def compute_all_scores(dir=None):
+@timed("compute_all_scores")
+def compute_all_scores(dir=None, targets=None, db=None, run="latest", confidence=0.95):
     if dir == None:
         dir=""
+    if targets is None:
+        targets = default_targets
 
     def csv(f):
         return pd.read_csv(f, sep=",")
 
-    bench = csv(os.path.join(dir, "bench.csv"))
+    if db is not None:
+        # Score a run from the results store instead of bench.csv.
+        import results_db
+        with span("autograde.read", db=db):
+            bench = results_db.query(db, run=run, function=[f for f in set(targets['function']) | set(targets.get('reference_function', [])) if isinstance(f, str)])
+        if bench.empty:
+            raise FileNotFoundError(f"No benchmark results in {db} for run {run}")
+    else:
+        with span("autograde.read", file=os.path.join(dir, "bench.csv")):
+            bench = csv(os.path.join(dir, "bench.csv"))
 
-    bench["label"] = bench["function"] + " " + list(map(str,bench["customers"]))+ " " + list(map(str,bench["products"])) + " " + list(map(str,bench["brands"]))
+    bench["label"] = make_labels(bench)
     #                                     baseline ET     Speedup
     # scores = compute_scores(bench, "ET",[(3.19,2.2),
     #                                      (7.52,3.5),
     #                                      (2.9,18.5)])
-    scores = compute_scores(bench, "ET",[(0.017,2)])
-    
-    scores['score'] = round(scores['bench_score']/len(scores),2)
-    scores['capped_score'] = list(map(lambda x: min(100.0/len(scores), x), scores['score']))
-    
-    return scores.copy()
+    with span("autograde.score"):
+        scores = compute_scores(bench, "ET", targets, confidence=confidence)
+        return finalize_scores(scores)
+
+def score_submissions(root, targets=None, confidence=0.95):
+    # Score every submission directory under root (the ones with a
+    # bench.csv) in one pass.  The result has a 'submission' column.
+    if targets is None:
+        targets = default_targets
+
+    benches = []
+    for d in sorted(os.listdir(root)):
+        f = os.path.join(root, d, "bench.csv")
+        if os.path.exists(f):
+            try:
+                b = pd.read_csv(f, sep=",")
+            except (OSError, ValueError):
+                continue  # Left out; grade_submission() reports what's wrong with it.
+            b["submission"] = d
+            benches.append(b)
+    if not benches:
+        raise FileNotFoundError(f"No submissions with a bench.csv in {root}")
+
+    bench = pd.concat(benches, ignore_index=True)
+    bench["label"] = make_labels(bench)
+    return finalize_scores(compute_scores(bench, "ET", targets, confidence=confidence), by="submission")
     
 
-@click.command()
-@click.option("--submission", required=True,  type=click.Path(exists=True), help="Test directory")
-@click.option("--results", required=True, type = click.File(mode="w"), help="Where to put results")
-def autograde(submission=None, results=None):
+def grade_submission(submission, targets=None, stdout_file="/autograder/results/stdout", confidence=0.95, scores=None):
+    # `scores` are this submission's rows of score_submissions(), if they've
+    # been computed already.
+    import results_db
+    if os.path.exists(os.path.join(submission, "bench.csv")):
+        results_db.record(os.path.join(submission, "bench.csv"), results_db.run_metadata(submission),
+                          kind="autograde", submission=os.path.basename(os.path.abspath(submission)))
     try:
         failures = 1 - compute_correctness(dir=submission)
         output = "tests passed" if failures == 0 else "Your code is incorrect"
@@ -83,7 +283,8 @@ def autograde(submission=None, results=None):
     benchmarks = []
     leaderboard=[]
     try:
-        scores  = compute_all_scores(dir=submission)
+        if scores is None:
+            scores  = compute_all_scores(dir=submission, targets=targets, confidence=confidence)
     except FileNotFoundError as e:
         benchmarks.append(dict(score=0,
                                max_score=100,
@@ -98,30 +299,103 @@ def autograde(submission=None, results=None):
                                visibility="visible"))
     else:
         count = len(scores)
-        for index, row in scores.iterrows():
+        for row in scores.to_dict("records"):
             benchmarks.append(dict(score=round(row['capped_score'],2) if failures == 0 else 0,
                     max_score=100.0/count,
-                    output=f"Test: {row['label']}:  The target speedup is {row['target_speedup']:2.2f}x, your speedup is {row['speedup']:2.2f}x.  Your score is {row['speedup']:2.2f}/{row['target_speedup']}*{100.0/count:2.2f} = {row['score']:2.2f} (or {100.0/count}, if that values is greater than {100.0/count})" if failures == 0 else "Your code is incorrect, so speedup is meaningless.",
+                    output=f"Test: {row['label']}:  The target speedup is {row['target_speedup']:2.2f}x, your speedup is {row['speedup']:2.2f}x ({confidence*100:g}% confidence interval {row['speedup_low']:2.2f}x-{row['speedup_high']:2.2f}x over {row['reps']} reps).  Your score is {row['speedup']:2.2f}/{row['target_speedup']}*{100.0/count:2.2f} = {row['score']:2.2f} (or {100.0/count}, if that values is greater than {100.0/count})" if failures == 0 else "Your code is incorrect, so speedup is meaningless.",
                     tags=[],
-                    visibility="visible"))
+                    visibility="visible",
+                    extra_data=dict(speedup=row['speedup'],
+                                    speedup_low=row['speedup_low'],
+                                    speedup_high=row['speedup_high'],
+                                    reps=row['reps'],
+                                    measured_reference=row['measured_reference'])))
 
-        leaderboard = []
-        for index, row in scores.iterrows():
-            leaderboard.append(dict(name=row['label'] + " speedup", value=round(row['speedup'],2)))
+        leaderboard = [dict(name=label + " speedup", value=round(speedup,2))
+                       for label, speedup in zip(scores['label'], scores['speedup'])]
 
-    if os.path.exists("/autograder/results/stdout"):
-        with open("/autograder/results/stdout") as f:
+    if os.path.exists(stdout_file):
+        with open(stdout_file) as f:
             stdout = f.read()
     else:
         stdout = ""
         
     # https://gradescope-autograders.readthedocs.io/en/latest/specs/#output-format
-    json.dump(dict(output=stdout,
-                   visibility="visible",
-                   stdout_visibility="visible",
-                   tests=benchmarks,
-                   leaderboard=leaderboard
-        ), results, indent=4)
-        
+    return dict(output=stdout,
+                visibility="visible",
+                stdout_visibility="visible",
+                tests=benchmarks,
+                leaderboard=leaderboard)
+
+@click.command()
+@click.option("--submission", required=True,  type=click.Path(exists=True), help="Test directory")
+@click.option("--results", required=True, type = click.File(mode="w"), help="Where to put results")
+@click.option("--confidence", default=0.95, help="Confidence level of the reported speedup intervals")
+def autograde(submission=None, results=None, confidence=None):
+    json.dump(grade_submission(submission, confidence=confidence), results, indent=4)
+
+
+_batch_targets = None
+
+def _init_batch_worker(targets):
+    global _batch_targets
+    _batch_targets = targets
+
+def _grade_one(args):
+    submission, out, scores = args
+    result = grade_submission(submission, targets=_batch_targets, stdout_file=os.path.join(submission, "stdout"), scores=scores)
+    with open(out, "w") as f:
+        json.dump(result, f, indent=4)
+    return result
+
+@click.command()
+@click.option("--root", required=True, type=click.Path(exists=True, file_okay=False), help="Directory with one subdirectory per submission")
+@click.option("--results", required=True, type=click.Path(file_okay=False), help="Where to put each submission's results")
+@click.option("--leaderboard", "leaderboard_file", default=None, type=click.Path(dir_okay=False), help="Combined leaderboard (default: RESULTS/leaderboard.json)")
+@click.option("--targets", "targets_file", default=None, type=click.Path(exists=True, dir_okay=False), help="CSV of targets (default: built in)")
+@click.option("--jobs", default=None, type=int, help="Worker processes (default: one per CPU)")
+def autograde_batch(root=None, results=None, leaderboard_file=None, targets_file=None, jobs=None):
+    # Grade every submission under root.  The benchmarks of all of them are
+    # scored together, in one pass, by score_submissions(); then a pool of
+    # workers checks correctness and writes each submission's results.  The
+    # workers are forked from this process, so they start with pandas
+    # already imported and the targets table already loaded.  Submissions
+    # score_submissions() couldn't read are scored on their own, so they get
+    # the usual error message.
+    from concurrent.futures import ProcessPoolExecutor
+
+    targets = pd.read_csv(targets_file) if targets_file else default_targets
+    os.makedirs(results, exist_ok=True)
+    if leaderboard_file is None:
+        leaderboard_file = os.path.join(results, "leaderboard.json")
+
+    submissions = sorted(d for d in os.listdir(root)
+                         if os.path.isdir(os.path.join(root, d)) and os.path.abspath(os.path.join(root, d)) != os.path.abspath(results))
+    try:
+        scores = score_submissions(root, targets)
+    except (FileNotFoundError, KeyError, ValueError) as e:
+        print(f"Couldn't score the submissions together ({e}); scoring them one at a time.")
+        scores = None
+    by_submission = dict(iter(scores.groupby("submission"))) if scores is not None else {}
+    work = [(os.path.join(root, d), os.path.join(results, f"{d}.json"), by_submission.get(d)) for d in submissions]
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_batch_worker, initargs=(targets,)) as pool:
+        graded = list(pool.map(_grade_one, work, chunksize=max(1, len(work)//(4*(jobs or os.cpu_count() or 1)))))
+
+    leaderboard = []
+    for d, result in zip(submissions, graded):
+        entry = dict(submission=d,
+                     score=round(sum(t['score'] for t in result['tests']), 2))
+        for l in result['leaderboard']:
+            entry[l['name']] = l['value']
+        leaderboard.append(entry)
+    leaderboard.sort(key=lambda e: e['score'], reverse=True)
+    with open(leaderboard_file, "w") as f:
+        json.dump(leaderboard, f, indent=4)
+    print(f"Graded {len(submissions)} submissions.  Results are in {results}; leaderboard is in {leaderboard_file}.")
+
 if __name__== "__main__":
-    autograde()
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        autograde_batch(args=sys.argv[2:], prog_name=f"{sys.argv[0]} batch")
+    else:
+        autograde()
@@ -0,0 +1,250 @@
+# Where benchmark runs happen.
+#
+# A backend runs a list of commands and returns a CommandResult for each.
+# It also points cfiddle's runner (RunnerExecutionMethod_type) at the
+# execution method that goes with it.  The calls stay the same.
+#
+#   "hungwei"  cfiddle runs go through HungWeiExecutionMethod.  Our own
+#              commands (sweep(), run_until_converged(), autotune_tile(),
+#              ...) run right here, one at a time.  This is the default.
+#   "local"    A queue of jobs served by long-lived worker processes, each
+#              pinned to its own core.  Workers take jobs in batches, so
+#              a sweep doesn't pay for a process launch per run.  cfiddle
+#              runs go through the same queue (LocalExecutionMethod).
+#
+# Choose one with setup(backend=...) in notebook.py, set_backend(), or the
+# FIDDLE_BACKEND environment variable.
+
+import math
+import os
+import shlex
+import subprocess
+from collections import namedtuple
+
+CommandResult = namedtuple("CommandResult", "ok returncode output core", defaults=(None,))
+
+
+def _core_siblings(core):
+    try:
+        with open(f"/sys/devices/system/cpu/cpu{core}/topology/thread_siblings_list") as f:
+            return f.read().strip()
+    except OSError:
+        return str(core)
+
+
+def _parse_cpu_list(s):
+    cores = []
+    for r in s.strip().split(","):
+        if not r:
+            continue
+        lo, _, hi = r.partition("-")
+        cores += list(range(int(lo), int(hi or lo) + 1))
+    return cores
+
+
+def sweep_cores(policy="exclusive"):
+    # Cores a sweep may use.  "exclusive" uses one hyperthread per physical
+    # core (siblings share L1 and the TLBs), prefers isolcpus cores, and leaves
+    # the first core alone for the notebook kernel.  "oversubscribe" uses
+    # every core we are allowed to run on.
+    allowed = sorted(os.sched_getaffinity(0))
+    if policy == "oversubscribe":
+        return allowed
+    elif policy != "exclusive":
+        raise ValueError(f"Unknown placement policy '{policy}'.  Use 'exclusive' or 'oversubscribe'.")
+
+    try:
+        with open("/sys/devices/system/cpu/isolated") as f:
+            isolated = [c for c in _parse_cpu_list(f.read()) if c in allowed]
+    except OSError:
+        isolated = []
+    candidates = isolated or allowed[1:] or allowed
+
+    # The notebook's core's hyperthread sibling isn't free either.
+    cores, seen = [], {_core_siblings(allowed[0])} if allowed[0] not in candidates else set()
+    for c in candidates:
+        siblings = _core_siblings(c)
+        if siblings not in seen:
+            seen.add(siblings)
+            cores.append(c)
+    return cores
+
+
+def _argv(cmd):
+    # A command is a string, split like a shell would (so quoted paths with
+    # spaces survive), or an argv list, used as is.
+    return shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+
+
+def _display(cmd):
+    return cmd if isinstance(cmd, str) else shlex.join(cmd)
+
+
+def _run_one(cmd, quiet=True, core=None):
+    # Run cmd, streaming its output unless quiet.
+    if not quiet:
+        print(_display(cmd), flush=True)
+    p = subprocess.Popen(_argv(cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors="replace")
+    output = []
+    for l in p.stdout:
+        output.append(l)
+        if not quiet:
+            print(l, end="", flush=True)
+    returncode = p.wait()
+    output = "".join(output)
+    return CommandResult(ok=returncode == 0, returncode=returncode, output=output, core=core)
+
+
+class Backend:
+    # run(cmds) runs each command (a string, split on whitespace, or an argv
+    # list) and returns a CommandResult for each, in order.  configure()
+    # sets cfiddle up to match; set_backend() calls it and sets `configured`.
+    configured = False
+
+    def configure(self):
+        pass
+
+    def run(self, cmds, quiet=True):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def _set_cfiddle_method(method):
+    import cfiddle
+    cfiddle.set_config("RunnerExecutionMethod_type", method)
+
+
+class HungWeiBackend(Backend):
+    def configure(self):
+        from hungwei import HungWeiExecutionMethod
+        _set_cfiddle_method(HungWeiExecutionMethod)
+
+    def run(self, cmds, quiet=True):
+        results = []
+        for c in cmds:
+            results.append(_run_one(c, quiet))
+            if quiet and not results[-1].ok:
+                print(results[-1].output)
+        return results
+
+
+# The worker side of LocalBackend.  Each worker process pins itself to a
+# core from the queue when it starts; the commands it runs inherit that.
+_worker_core = None
+
+def _pin_worker(cores):
+    global _worker_core
+    _worker_core = cores.get()
+    os.sched_setaffinity(0, {_worker_core})
+
+def _run_batch(cmds):
+    return [tuple(_run_one(c, quiet=True, core=_worker_core)) for c in cmds]
+
+
+class LocalBackend(Backend):
+    # workers, policy and cores are as for sweep().  `batch` is the most jobs
+    # a worker takes at once.  Workers start on first use and live until
+    # close().
+    def __init__(self, workers=None, policy="exclusive", cores=None, batch=8):
+        if cores is None:
+            cores = sweep_cores(policy)
+        if workers is None:
+            workers = len(cores) if policy == "exclusive" else os.cpu_count()
+        if policy == "exclusive":
+            workers = min(workers, len(cores))
+        self.policy = policy
+        self.cores = cores
+        self.workers = workers
+        self.batch = batch
+        self._pool = None
+        self._warned = False
+
+    def configure(self):
+        LocalExecutionMethod.backend = self
+        _set_cfiddle_method(LocalExecutionMethod)
+
+    def _start(self):
+        if self._pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # spawn, not fork: the notebook kernel has threads of its own.
+            ctx = multiprocessing.get_context("spawn")
+            cores = ctx.Queue()
+            for i in range(self.workers):
+                cores.put(self.cores[i % len(self.cores)])
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx,
+                                             initializer=_pin_worker, initargs=(cores,))
+        return self._pool
+
+    def run(self, cmds, quiet=True):
+        cmds = list(cmds)
+        if not cmds:
+            return []
+        if self.policy != "exclusive" and not self._warned:
+            print("Oversubscribed workers: performance numbers are not meaningful.")
+            self._warned = True
+        # Smaller batches when there are few jobs, so every worker gets some.
+        n = max(1, min(self.batch, math.ceil(len(cmds)/self.workers)))
+        batches = [cmds[i:i + n] for i in range(0, len(cmds), n)]
+        results = []
+        for b, r in zip(batches, self._start().map(_run_batch, batches)):
+            for cmd, result in zip(b, r):
+                result = CommandResult(*result)
+                if not quiet:
+                    print(_display(cmd))
+                if not quiet or not result.ok:
+                    print(result.output, end="")
+                results.append(result)
+        return results
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+class LocalExecutionMethod:
+    # cfiddle's RunnerExecutionMethod_type for LocalBackend.  cfiddle hands
+    # us the command that runs a batch of invocations (`cfiddle-run ...`);
+    # it becomes one job on the backend's queue, so it runs on a pinned
+    # worker like everything else.  cfiddle makes its own instances, so the
+    # backend is a class attribute, set by LocalBackend.configure().
+    backend = None
+
+    def execute(self, command, runner):
+        backend = self.backend or get_backend()
+        r = backend.run([command if isinstance(command, str) else list(command)])[0]
+        if not r.ok:
+            raise Exception(f"{_display(command)} failed on core {r.core} (exit code {r.returncode}): {r.output}")
+
+
+backends = dict(hungwei=HungWeiBackend, local=LocalBackend)
+
+_backend = None
+
+
+def set_backend(backend="hungwei", **options):
+    # backend is a name from `backends` (options go to its constructor) or a
+    # Backend.  Returns the backend, configured and ready to use.
+    global _backend
+    if isinstance(backend, str):
+        if backend not in backends:
+            raise ValueError(f"Unknown backend '{backend}'.  Use one of {', '.join(backends)}.")
+        backend = backends[backend](**options)
+    backend.configure()
+    backend.configured = True
+    if _backend is not None and _backend is not backend:
+        _backend.close()
+    _backend = backend
+    return backend
+
+
+def get_backend():
+    # The current backend.  Until set_backend() is called, that's the one
+    # FIDDLE_BACKEND names (HungWei by default), not yet configured.
+    global _backend
+    if _backend is None:
+        _backend = backends[os.environ.get("FIDDLE_BACKEND", "hungwei")]()
+    return _backend
@@ -240,6 +240,40 @@ public:
     }
 };
 
+// Like raw_bytes, but with arg1, and only the bytes the run uses (size) are
+// refilled before each rep, so small sizes don't pay for the biggest one.
+class raw_bytes_1arg: public benchmark_env<uint64_t*(*)(uint64_t *, unsigned long int, unsigned long int)> {
+    uint8_t * array;
+    uint64_t max_size;
+public:
+    raw_bytes_1arg(uint64_t max_size): max_size(max_size) {
+        array =  new uint8_t[max_size];
+    }
+    
+    void reset_environment(const parameter_map_t & parameters) {
+        uint64_t a = 1;
+        uint64_t * t = reinterpret_cast<uint64_t*>(array);
+        uint64_t size = std::min(boost::any_cast<uint64_t>(parameters.at("size")), max_size);
+        
+        for (unsigned int i = 0; i < size/sizeof(uint64_t); i++) {
+            t[i] = fast_rand(&a);
+        }
+    }
+    
+    std::function<void()> get_function(void * the_func, parameter_map_t & parameters) {
+        uint64_t size = boost::any_cast<uint64_t>(parameters["size"]);
+        uint64_t arg1 = boost::any_cast<uint64_t>(parameters["arg1"]);
+        auto f = cast_function(the_func);
+        uint64_t * _array = reinterpret_cast<uint64_t*>(array);
+        return [f, _array, size, arg1]() {
+                   f(_array, size, arg1);
+               };
+    }
+    ~raw_bytes_1arg() {
+        delete [] array;
+    }
+};
+
 int main(int argc, char *argv[])
 {
 
@@ -412,6 +446,7 @@ int main(int argc, char *argv[])
     REGISTER_ENV(three_arrays, new three_arrays(*std::max_element(sizes.begin(), sizes.end())));
     REGISTER_ENV(convolution, new convolution(*std::max_element(sizes.begin(), sizes.end())));
     REGISTER_ENV(raw_bytes, new raw_bytes(*std::max_element(sizes.begin(), sizes.end())));
+    REGISTER_ENV(raw_bytes_1arg, new raw_bytes_1arg(*std::max_element(sizes.begin(), sizes.end())));
     REGISTER_ENV(alloc_test, new alloc_test);
 
 //    theDataCollector->disable_prefetcher();
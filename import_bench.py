@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# Check that `import notebook` stays cheap.  It's imported in a fresh
+# interpreter `--runs` times; the fastest import has to fit in `--budget`
+# seconds and none of the heavy modules may be loaded by the import itself.
+# Exits non-zero if either check fails, so it can run in CI (`make import-bench`).
+
+import json
+import os
+import subprocess
+import sys
+import click
+
+heavy_modules = ["matplotlib", "pandas", "numpy", "IPython", "click", "cfiddle", "delegate_function", "hungwei", "h5py"]
+
+_probe = """
+import json, sys, time, contextlib, io
+sys.path.insert(0, {dir!r})
+start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    import notebook
+elapsed = time.perf_counter() - start
+print(json.dumps(dict(seconds=elapsed, loaded=[m for m in {heavy!r} if m in sys.modules])))
+"""
+
+def measure(runs=5, dir=None):
+    # [(seconds, [heavy modules loaded]), ...], one per run.
+    code = _probe.format(dir=os.path.abspath(dir or os.path.dirname(__file__) or "."), heavy=heavy_modules)
+    results = []
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, "-c", code], cwd=dir or None)
+        r = json.loads(out.decode().strip().splitlines()[-1])
+        results.append((r['seconds'], r['loaded']))
+    return results
+
+@click.command()
+@click.option("--runs", default=5, help="Number of fresh interpreters to time")
+@click.option("--budget", default=0.25, help="Most seconds the fastest import may take")
+def main(runs=None, budget=None):
+    results = measure(runs)
+    best = min(s for s, _ in results)
+    loaded = sorted(set(m for _, l in results for m in l))
+    print(f"import notebook: best {best*1000:.1f} ms of {runs} (budget {budget*1000:.0f} ms)")
+    ok = True
+    if best > budget:
+        print("FAIL: importing notebook got slower than the budget")
+        ok = False
+    if loaded:
+        print(f"FAIL: importing notebook loaded {', '.join(loaded)}; import them where they're used instead")
+        ok = False
+    if not ok:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,125 +1,434 @@
 import warnings
 warnings.filterwarnings('ignore')
-import matplotlib.pyplot as plt
 import math
-from IPython.display import IFrame, Image, TextDisplayObject
+import importlib
 import subprocess 
+import asyncio
+import time
+import contextvars
+import bisect
+import signal
+import shlex
 import os
+import sys
+import hashlib
+import json
+import pickle
+import shutil
 from collections import namedtuple
-from IPython.display import display, Markdown, Latex, Code, HTML
+from contextlib import contextmanager
 import re
-import copy
-import pandas
-from autograde import *
+import io
 import glob
-from IPython.core.display import HTML
-import delegate_function
-import cfiddle
-from cfiddle import *
-from hungwei import HungWeiExecutionMethod
-cfiddle.set_config("RunnerExecutionMethod_type", HungWeiExecutionMethod)
-
-import os
 from pathlib import Path
-with open(str(Path.home())+"/.ssh/id_rsa.pub", 'r') as file:
-    pub_key = file.read()
-file.close()
-if not (os.path.isfile(str(Path.home())+"/.ssh/authorized_keys")): 
-    authorized_keys = open(str(Path.home())+"/.ssh/authorized_keys", 'w')
-    authorized_keys.close()
-authorized_keys = open(str(Path.home())+"/.ssh/authorized_keys", 'r')
-if pub_key in authorized_keys.read():
-    print('The key is already registered')
-else:
-    authorized_keys.close()
-    authorized_keys = open(str(Path.home())+"/.ssh/authorized_keys", 'a')
-    authorized_keys.write(pub_key)
+from spans import span, timed
+from backends import CommandResult, sweep_cores, set_backend, get_backend, LocalBackend
+
+# Importing this module has to be quick, since it happens on every kernel
+# restart.  So the heavy modules (matplotlib, pandas, numpy, IPython,
+# cfiddle...) are only imported the first time something uses them, and the
+# one-time environment setup happens in setup().  import_bench.py checks
+# that it stays that way.
+
+class _LazyModule:
+    # Stands in for a module and imports it the first time one of its
+    # attributes is used.  on_load(module) runs once, after the import.
+    def __init__(self, name, on_load=None):
+        self._name = name
+        self._on_load = on_load
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+            if self._on_load:
+                self._on_load(self._module)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r}{' (loaded)' if self._module else ''}>"
+
+def _configure_pandas(pandas):
+    pandas.set_option('display.max_rows', 130)
+
+plt = _LazyModule("matplotlib.pyplot")
+pandas = pd = _LazyModule("pandas", on_load=_configure_pandas)
+np = _LazyModule("numpy")
+delegate_function = _LazyModule("delegate_function")
+
+def _configure_cfiddle(module=None):
+    # Point cfiddle at the current backend (HungWei unless FIDDLE_BACKEND or
+    # setup() says otherwise) the first time anything here uses it, so code
+    # that never calls setup() still runs where it always did.
+    b = get_backend()
+    if not b.configured:
+        set_backend(b)
+
+cfiddle = _LazyModule("cfiddle", on_load=_configure_cfiddle)
+
+# The names `from IPython.display import ...` used to put here.  They come
+# through __getattr__ below, so they're the real classes (isinstance() and
+# subclassing work).  Code in this module uses them through _ipython.
+_ipython = _LazyModule("IPython.display")
+_ipython_names = ["display", "IFrame", "Image", "TextDisplayObject", "Markdown", "Latex", "Code", "HTML"]
+
+# The modules whose names `from cfiddle import *` and `from autograde import *`
+# used to put here, in order of precedence.
+_star_modules = ["cfiddle", "autograde", "IPython.display"]
+
+def _import_star_module(name):
+    module = importlib.import_module(name)
+    if name == "cfiddle":
+        _configure_cfiddle()
+    return module
+
+def _public_names(module):
+    return getattr(module, "__all__", [n for n in dir(module) if not n.startswith("_")])
+
+def __getattr__(name):
+    # notebook.build, notebook.compute_scores, notebook.HTML, etc.: the names
+    # the star imports of cfiddle, autograde and IPython.display used to put
+    # here.  __all__ is computed here too, so `from notebook import *` still
+    # brings all of them in (and only then imports those modules).
+    if name == "__all__":
+        names = [n for n in globals() if not n.startswith("_")]
+        for m in reversed(_star_modules):
+            try:
+                module = _import_star_module(m)
+            except ImportError:
+                continue
+            names += _ipython_names if m == "IPython.display" else _public_names(module)
+        return list(dict.fromkeys(names))
+    if not name.startswith("_"):
+        for m in _star_modules:
+            try:
+                module = _import_star_module(m)
+            except ImportError:
+                continue
+            if hasattr(module, name):
+                return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(set(globals()) | set(_ipython_names))
+
+def do_cfg(*args, **kwargs):
+    # Used to come in with `from cfiddle import *`.
+    return __getattr__("do_cfg")(*args, **kwargs)
+
+if "cfiddle" in sys.modules:
+    _configure_cfiddle()  # Already paid for, so don't wait for first use.
+
+if "/usr/local/bin" not in os.environ['PATH'].split(":"):
+    os.environ['PATH']=f"{os.environ['PATH']}:/usr/local/bin"
+
+def register_ssh_key():
+    with open(str(Path.home())+"/.ssh/id_rsa.pub", 'r') as file:
+        pub_key = file.read()
+    if not (os.path.isfile(str(Path.home())+"/.ssh/authorized_keys")): 
+        authorized_keys = open(str(Path.home())+"/.ssh/authorized_keys", 'w')
+        authorized_keys.close()
+    with open(str(Path.home())+"/.ssh/authorized_keys", 'r') as authorized_keys:
+        if pub_key in authorized_keys.read():
+            print('The key is already registered')
+            return
+    with open(str(Path.home())+"/.ssh/authorized_keys", 'a') as authorized_keys:
+        authorized_keys.write(pub_key)
     print('We\'re done!')
-authorized_keys.close()
 
-#styles = open("./styles/custom.css", "r").read()
-styles = "div.prompt, code, output, prompt, kbd, pre, samp {font-family: 'SF Mono', 'Courier New', Courier, monospace, sans-serif !important;}"
-display(HTML('<style>' + styles + '</style>'))
-os.environ['PATH']=f"{os.environ['PATH']}:/usr/local/bin"
+_setup_done = False
+
+def setup(force=False, backend=None, **backend_options):
+    # The one-time environment setup: register our ssh key, pick the
+    # execution backend (see backends.py; the default is FIDDLE_BACKEND or
+    # "hungwei"), load the notebook styles, and make cfiddle's names
+    # available in the notebook like `from cfiddle import *` would.  Calling
+    # it again does nothing unless force=True.
+    global _setup_done
+    if _setup_done and not force:
+        return
+    register_ssh_key()
+
+    set_backend(backend or os.environ.get("FIDDLE_BACKEND", "hungwei"), **backend_options)
+
+    #styles = open("./styles/custom.css", "r").read()
+    styles = "div.prompt, code, output, prompt, kbd, pre, samp {font-family: 'SF Mono', 'Courier New', Courier, monospace, sans-serif !important;}"
+    _ipython.display(_ipython.HTML('<style>' + styles + '</style>'))
+
+    from IPython import get_ipython
+    shell = get_ipython()
+    if shell is not None:
+        c = _import_star_module("cfiddle")
+        names = getattr(c, "__all__", [n for n in dir(c) if not n.startswith("_")])
+        for n in names:
+            shell.user_ns.setdefault(n, getattr(c, n))
+    _setup_done = True
 
 pa_columns=["function", "seed", "size", "power","p1", "p2", "p3", "p4", "p5", "IC", "CPI", "CT", "ET", "L1_MPI", "TLB_MPI", "L1_cache_misses", "TLB_misses"]
 default_layers=["misses-compulsory-all", "misses-capacity-all", "hits-all"]
 
-pandas.set_option('display.max_rows', 130)
+# Column types for the stats CSVs that fiddle.exe/join.exe write.  Anything not
+# listed here is left to pandas to infer.  Parameters are int64, so
+# differences and arithmetic with negative numbers behave; only the hardware
+# counters, which can use all 64 bits, are uint64.
+pa_parameter_columns=["seed", "size", "rep", "arg1", "tile_size", "customers", "products", "brands"]
+pa_counter_columns=["IC", "Cycles", "L1_cache_misses", "TLB_misses", "L1_dcache_misses", "L1_dcache_accesses"]
+pa_ratio_columns=["CPI", "L1_MPI", "TLB_MPI", "L1_dcache_miss_rate"]
+pa_dtypes=dict([("function", "category")] +
+               [(c, "int64") for c in pa_parameter_columns] +
+               [(c, "uint64") for c in pa_counter_columns] +
+               [(c, "float32") for c in pa_ratio_columns])
+csv_cache_dir=".csv_cache"
+csv_cache_version=2  # Bump when pa_dtypes changes, so old cache entries get re-parsed.
+
 
 user = None
 
 RenderedCode =namedtuple("RenderedCode", "source asm cfg cfg_counts gprof call_graph stats mtrace")
 
-def shell_cmd(cmd, shell=False, quiet_on_success=False):
-    try:
+async def shell_cmd_async(cmd, shell=False, quiet_on_success=False, timeout=None, semaphore=None):
+    # Like shell_cmd(), but output is printed as it arrives (or, with
+    # quiet_on_success, only if the command fails).  The command is killed if
+    # it runs longer than timeout seconds or the task is cancelled.  Pass a
+    # shared asyncio.Semaphore to bound how many commands run at once.
+    if semaphore is not None:
+        async with semaphore:
+            return await shell_cmd_async(cmd, shell=shell, quiet_on_success=quiet_on_success, timeout=timeout)
+
+    with span("shell", cmd=cmd):
         if not quiet_on_success:
             print(cmd)
+        # Own session, so we can kill a whole pipeline, not just the shell.
         if shell:
-            p = subprocess.run(cmd, shell=True, check=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+            p = await asyncio.create_subprocess_shell(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
         else:
-            p = subprocess.run(cmd.split(), check=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+            p = await asyncio.create_subprocess_exec(*cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+
+        output = []
+        async def pump():
+            while True:
+                chunk = await p.stdout.read(65536)
+                if not chunk:
+                    break
+                chunk = chunk.decode(errors="replace")
+                output.append(chunk)
+                if not quiet_on_success:
+                    print(chunk, end="", flush=True)
+            return await p.wait()
+
+        def kill():
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        try:
+            returncode = await asyncio.wait_for(pump(), timeout)
+        except asyncio.TimeoutError:
+            kill()
+            await p.wait()
+            output.append(f"\n'{cmd}' timed out after {timeout} seconds.\n")
+            if not quiet_on_success:
+                print(output[-1], end="")
+            returncode = None
+        except asyncio.CancelledError:
+            kill()
+            await p.wait()
+            raise
+
+        output = "".join(output)
+        if returncode != 0 and quiet_on_success:
+            print(output)
+        return CommandResult(ok=returncode == 0, returncode=returncode, output=output)
+
+
+def run_async(coro):
+    # Run a coroutine to completion from synchronous code.  Jupyter already
+    # has an event loop running in the kernel thread, so use a helper thread
+    # with its own loop in that case.
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        # Carry our context over, so spans in the coroutine nest under ours.
+        return pool.submit(contextvars.copy_context().run, asyncio.run, coro).result()
+
+
+def run_commands(cmds, limit=None, shell=True, quiet_on_success=True, timeout=None):
+    # Run several commands concurrently, at most `limit` at a time.  Returns
+    # a CommandResult for each, in order.
+    if limit is None:
+        limit = os.cpu_count()
+    async def go():
+        semaphore = asyncio.Semaphore(limit)
+        return await asyncio.gather(*[shell_cmd_async(c, shell=shell, quiet_on_success=quiet_on_success, timeout=timeout, semaphore=semaphore)
+                                      for c in cmds])
+    return run_async(go())
 
-        if not quiet_on_success:
-            print(p.stdout.decode())
-        return True
-    except subprocess.CalledProcessError as e:
-        print(e.output.decode())
-        return False
+
+def shell_cmd(cmd, shell=False, quiet_on_success=False, timeout=None):
+    return run_async(shell_cmd_async(cmd, shell=shell, quiet_on_success=quiet_on_success, timeout=timeout)).ok
 
 
     
-def do_gprof(exe, gmon="gmon.out", out=None):
+async def do_gprof_async(exe, gmon="gmon.out", out=None, semaphore=None):
     if out is None:
         out = f"{exe}.gprof"
-    shell_cmd(f"gprof {exe} > {out}", shell=True, quiet_on_success=True)
+    await shell_cmd_async(f"gprof {exe} > {out}", shell=True, quiet_on_success=True, semaphore=semaphore)
     with open(out) as f:
-        return HTML(f"<pre>{f.read()}</pre>")
+        return _ipython.HTML(f"<pre>{f.read()}</pre>")
+
+def do_gprof(exe, gmon="gmon.out", out=None):
+    return run_async(do_gprof_async(exe, gmon, out))
 
     
-def do_call_graph(exe, gmon="gmon.out", root=None, out=None):
+async def do_call_graph_async(exe, gmon="gmon.out", root=None, out=None, semaphore=None):
     if not root:
         root = "main"
         
     if out is None:
         out = f"{exe}.call_graph.png"
-    shell_cmd(f"gprof {exe} | gprof2dot -n0 -e0 -z {root} | dot -Tpng -o {out}", shell=True, quiet_on_success=False)
-    return Image(out)
+    await shell_cmd_async(f"gprof {exe} | gprof2dot -n0 -e0 -z {root} | dot -Tpng -o {out}", shell=True, quiet_on_success=False, semaphore=semaphore)
+    return _ipython.Image(out)
+
+def do_call_graph(exe, gmon="gmon.out", root=None, out=None):
+    return run_async(do_call_graph_async(exe, gmon, root, out))
 
+
+async def demangle_async(file, semaphore=None):
+    r = await shell_cmd_async(f"c++filt < {shlex.quote(file)}", shell=True, quiet_on_success=True, semaphore=semaphore)
+    if not r.ok:
+        raise Exception(f"Couldn't demangle {file}")
+    return r.output
+
+reps_cache_dir = ".reps_cache"
+_reps_memo = {}
+_file_hashes = {}
+_render_pool = None
+
+def _file_hash(path):
+    st = os.stat(path)
+    k = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    if k not in _file_hashes:
+        with open(path, "rb") as f:
+            _file_hashes[k] = hashlib.sha1(f.read()).hexdigest()
+    return _file_hashes[k]
+
+
+def cached_render(kind, files, render, **options):
+    # Memoize render() on the contents of `files` and the render options, in
+    # memory and in reps_cache_dir, so re-running a cell for an unchanged
+    # object file doesn't redo gprof, dot, c++filt, etc.
+    try:
+        hashes = [_file_hash(f) for f in files]
+    except OSError:
+        with span(f"render.{kind}"):
+            return render()
+    key = hashlib.sha1(repr((kind, hashes, sorted(options.items()))).encode()).hexdigest()
+    if key in _reps_memo:
+        return _reps_memo[key]
+
+    path = os.path.join(reps_cache_dir, f"{key}.pickle")
+    try:
+        with open(path, "rb") as f:
+            r = pickle.load(f)
+    except Exception:
+        with span(f"render.{kind}"):
+            r = render()
+        try:
+            os.makedirs(reps_cache_dir, exist_ok=True)
+            with open(f"{path}.{os.getpid()}.tmp", "wb") as f:
+                pickle.dump(r, f)
+            os.rename(f"{path}.{os.getpid()}.tmp", path)
+        except Exception:
+            pass
+    _reps_memo[key] = r
+    return r
+
+
+class LazyRender:
+    # Stands in for a rendered representation (Code, Image, HTML...) and only
+    # produces it when something looks at it, e.g., display().  start() kicks
+    # off the render on a shared thread pool, so several can run at once.
+    def __init__(self, render):
+        self._render = render
+        self._future = None
+
+    def start(self):
+        global _render_pool
+        if self._future is None:
+            if _render_pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _render_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+            self._future = _render_pool.submit(self._render)
+        return self
+
+    def get(self):
+        return self.start()._future.result()
+
+    def __getattr__(self, name):
+        if name.startswith("__") or name in ("_render", "_future"):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def __repr__(self):
+        return repr(self.get())
+
+
+def prefetch(*renders):
+    # Start all the lazy renders in `renders` so they run concurrently.
+    for r in renders:
+        if isinstance(r, LazyRender):
+            r.start()
+    return renders
+
+
+@timed("build_reps")
 def build_reps(src, asm, obj, function, mtrace=None, stats=None, gmon=None, run=None, *argc, **kwargs):
+    if gmon is None:
+        gmon = "gmon.out"
     if obj.endswith(".exe") and "gprof" in run:
-        gprof = do_gprof(obj, gmon)
-        call_graph = do_call_graph(obj, gmon, root=function)
+        gprof = LazyRender(lambda: cached_render("gprof", [obj, gmon], lambda: do_gprof(obj, gmon)))
+        call_graph = LazyRender(lambda: cached_render("call_graph", [obj, gmon], lambda: do_call_graph(obj, gmon, root=function), root=function))
     else:
         gprof = None
         call_graph = None
         
     if function:
-        cfg_counts=do_cfg(obj,
-                          output=f"{obj}-{function}-counts.png",
-                          symbol=function,
-                          jupyter=True,
-                          spacing=kwargs.get('spacing',1),
-                          inst_counts=True,
-                          remove_assembly=False,
-                          trim_addresses=False,
-                          trim_comments=False),
-        cfg=do_cfg(obj,
-                   output=f"{obj}-{function}-cfg.png",
-                   symbol=function,
-                   jupyter=True,
-                   spacing=kwargs.get('spacing',1),
-                   number_nodes=kwargs.get('number_nodes', False),
-                   remove_assembly=kwargs.get('remove_assembly', False),
-                   trim_addresses=kwargs.get('trim_addresses', True),
-                   trim_comments=kwargs.get('trim_comments', False))
+        counts_options = dict(output=f"{obj}-{function}-counts.png",
+                              symbol=function,
+                              jupyter=True,
+                              spacing=kwargs.get('spacing',1),
+                              inst_counts=True,
+                              remove_assembly=False,
+                              trim_addresses=False,
+                              trim_comments=False)
+        cfg_options = dict(output=f"{obj}-{function}-cfg.png",
+                           symbol=function,
+                           jupyter=True,
+                           spacing=kwargs.get('spacing',1),
+                           number_nodes=kwargs.get('number_nodes', False),
+                           remove_assembly=kwargs.get('remove_assembly', False),
+                           trim_addresses=kwargs.get('trim_addresses', True),
+                           trim_comments=kwargs.get('trim_comments', False))
+        cfg_counts = LazyRender(lambda: cached_render("cfg", [obj], lambda: do_cfg(obj, **counts_options), **counts_options))
+        cfg = LazyRender(lambda: cached_render("cfg", [obj], lambda: do_cfg(obj, **cfg_options), **cfg_options))
     else:
         cfg_counts = None
         cfg = None
 
+    demangle = kwargs.get("demangle", True)
     print("Done build representations.")    
-    return RenderedCode(source=do_render_code(file=src, lang="c++", show=function),
-                        asm=do_render_code(file=asm, lang="gas", demangle=kwargs.get("demangle", True), show=function),
+    return RenderedCode(source=LazyRender(lambda: cached_render("code", [src], lambda: do_render_code(file=src, lang="c++", show=function), show=function)),
+                        asm=LazyRender(lambda: cached_render("code", [asm], lambda: do_render_code(file=asm, lang="gas", demangle=demangle, show=function), show=function, demangle=demangle)),
                         cfg_counts=cfg_counts,
                         cfg=cfg,
                         gprof = gprof,
@@ -133,6 +442,181 @@ def render_czoo(file, function, *argc, **kwargs):
                 unopt=build_reps(file, function, *argc, **kwargs))
 
 
+backup_dir = ".fiddle_backups"
+
+def _next_backup(fname):
+    # The next free backup name for fname.  The counters live in an index file
+    # so we don't have to probe the backup directory one name at a time.  It's
+    # locked while we update it, since several kernels can share a directory.
+    import fcntl
+    index_file = os.path.join(backup_dir, "index.json")
+    os.makedirs(os.path.join(backup_dir, os.path.dirname(fname)), exist_ok=True)
+    root, ext = os.path.splitext(fname)
+    with open(index_file, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            index = json.loads(f.read() or "{}")
+        except ValueError:
+            index = {}
+
+        if fname not in index:
+            # First backup since the index was created.  Pick up after any old
+            # ones, i.e., {root}_NNNN{ext}, but not other files that happen to
+            # start with root.
+            pattern = re.compile(re.escape(os.path.basename(root)) + r"_(\d{4,})" + re.escape(ext))
+            existing = [int(m.group(1)) for m in map(pattern.fullmatch, os.listdir(os.path.join(backup_dir, os.path.dirname(fname)))) if m]
+            index[fname] = max(existing, default=-1) + 1
+        i = index[fname]
+        index[fname] = i + 1
+        f.seek(0)
+        f.truncate()
+        json.dump(index, f)
+    return os.path.join(backup_dir, f"{root}_{i:04}{ext}")
+
+
+# The build cache lives in /var/tmp, not a home directory, so it survives
+# across a user's kernels and checkouts.  Each user has their own, readable
+# only by them: a library from the cache gets loaded into your process, so
+# nobody else should be able to put one there.  Every entry records the
+# SHA-256 of its files, and a fetch that doesn't match is a miss.  Point
+# FIDDLE_BUILD_CACHE somewhere else to move it.
+build_cache_dir = os.environ.get("FIDDLE_BUILD_CACHE", f"/var/tmp/fiddle-build-{os.getuid()}")
+build_cache_max_bytes = int(os.environ.get("FIDDLE_BUILD_CACHE_MAX_BYTES", 2*1024**3))
+build_compiler = "g++-9"  # Keep in sync with COMPILER in Makefile
+build_artifacts = [".so", ".o", ".s"]
+
+_compiler_version = None
+def _get_compiler_version():
+    global _compiler_version
+    if _compiler_version is None:
+        try:
+            _compiler_version = subprocess.check_output([build_compiler, "--version"], stderr=subprocess.STDOUT).decode()
+        except (OSError, subprocess.CalledProcessError):
+            _compiler_version = ""
+    return _compiler_version
+
+
+def build_key(fname, opt=""):
+    # Everything that goes into the compiled artifacts: the source, the
+    # flags, the compiler, and the headers and make fragments the Makefile
+    # copies into build/.
+    h = hashlib.sha256()
+    with open(fname, "rb") as f:
+        h.update(f.read())
+    h.update(opt.encode())
+    h.update(_get_compiler_version().encode())
+    for dep in sorted(glob.glob("*.h") + glob.glob("*.hpp") + ["config.make", "Makefile"]):
+        if os.path.exists(dep):
+            h.update(dep.encode())
+            with open(dep, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for b in iter(lambda: f.read(1 << 20), b""):
+            h.update(b)
+    return h.hexdigest()
+
+
+def _fetch_artifacts(key, base):
+    # Copy a cache entry's artifacts next to base.  Each one is copied to a
+    # temporary name and checked against the entry's manifest before it
+    # replaces anything, so an entry that's corrupt, or evicted while we
+    # copy it, is just a miss.
+    entry = os.path.join(build_cache_dir, key)
+    copied = []
+    try:
+        with open(os.path.join(entry, "manifest.json")) as f:
+            manifest = json.load(f)
+        for a, digest in manifest.items():
+            # copy, rather than link, so make sees fresh mtimes and can't scribble on the cache.
+            tmp = f"{base}{a}.{os.getpid()}.tmp"
+            copied.append(tmp)
+            shutil.copyfile(os.path.join(entry, a), tmp)
+            if _sha256(tmp) != digest:
+                return False
+        for a in manifest:
+            os.rename(f"{base}{a}.{os.getpid()}.tmp", f"{base}{a}")
+        copied = []
+        os.utime(entry)  # LRU timestamp
+    except (OSError, ValueError):
+        return False
+    finally:
+        for tmp in copied:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+    return True
+
+
+def _store_artifacts(key, base):
+    entry = os.path.join(build_cache_dir, key)
+    tmp = f"{entry}.{os.getpid()}.tmp"
+    os.makedirs(tmp, exist_ok=True)
+    manifest = {}
+    for a in build_artifacts:
+        if os.path.exists(f"{base}{a}"):
+            shutil.copyfile(f"{base}{a}", os.path.join(tmp, a))
+            manifest[a] = _sha256(os.path.join(tmp, a))
+    with open(os.path.join(tmp, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)  # someone else stored it first.
+    evict_build_cache()
+
+
+def evict_build_cache(max_bytes=None):
+    # Drop least-recently-used entries until the cache fits in max_bytes.
+    if max_bytes is None:
+        max_bytes = build_cache_max_bytes
+    if not os.path.isdir(build_cache_dir):
+        return
+    entries = []
+    for e in os.scandir(build_cache_dir):
+        if e.is_dir() and not e.name.endswith(".tmp"):
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(e.path))
+                entries.append((e.stat().st_mtime, size, e.path))
+            except OSError:
+                continue  # Another kernel evicted it first.
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def build_cached(fname, opt=""):
+    # Build fname's artifacts, reusing them from the shared build cache if
+    # anyone on this host has compiled the same thing before.
+    base, _ = os.path.splitext(fname)
+    with span("build.cache_lookup"):
+        key = build_key(fname, opt)
+        if _fetch_artifacts(key, base):
+            print("Reusing cached build...")
+            return True
+    with span("build.compile", file=fname):
+        if not shell_cmd(f"make {base}.so {base}.s", quiet_on_success=True):
+            return False
+    with span("build.cache_store"):
+        try:
+            os.makedirs(build_cache_dir, mode=0o700, exist_ok=True)
+            _store_artifacts(key, base)
+        except OSError as e:
+            # The build itself worked; it just won't be reused.
+            print(f"Couldn't store the build in the cache ({e}).")
+    return True
+
+
+@timed("fiddle")
 def fiddle(fname, function=None, compile=True, name=None, code=None, opt=None, run=None, cmdline=None, perf_cmdline=None, analyze=False, **kwargs):
 
     # Maybe fiddle should have a liquid interface.  You could create an object
@@ -168,34 +652,26 @@ def fiddle(fname, function=None, compile=True, name=None, code=None, opt=None, r
     fname = os.path.join("build",fname)
 
     tagged_only = kwargs.pop("tagged_only", False)
-    if code is not None:
-        code = f"{code}\n//{opt}"  # this ensures we modify fname if optimization flags change, so we will recompile.
-        updated = False
-
-        if os.path.exists(fname):
-            with open(fname, "r") as  f:
-                old = f.read()
-            if old != code: 
-                updated = True
-        else:
-            updated = True
+    with span("fiddle.codegen"):
+        if code is not None:
+            code = f"{code}\n//{opt}"  # this ensures we modify fname if optimization flags change, so we will recompile.
+            updated = False
 
-        if updated:
             if os.path.exists(fname):
-                i = 0
-                root, ext = os.path.splitext(fname)
-                while True:
-                    os.makedirs(".fiddle_backups", exist_ok=True)
-                    os.makedirs(".fiddle_backups/build", exist_ok=True)
-                    p = f".fiddle_backups/{root}_{i:04}{ext}"
-                    if not os.path.exists(p):
-                        break
-                    i += 1
-                os.rename(fname, p)
+                with open(fname, "r") as  f:
+                    old = f.read()
+                if old != code: 
+                    updated = True
+            else:
+                updated = True
+
+            if updated:
+                if os.path.exists(fname):
+                    os.rename(fname, _next_backup(fname))
 
-            os.makedirs("build", exist_ok=True)
-            with open(fname, "w") as  f:
-                f.write(code)
+                os.makedirs("build", exist_ok=True)
+                with open(fname, "w") as  f:
+                    f.write(code)
     
     base, _ =  os.path.splitext(fname)
 
@@ -208,6 +684,10 @@ def fiddle(fname, function=None, compile=True, name=None, code=None, opt=None, r
         obj = so
 
 
+    if compile and not compile_together and os.path.exists(fname):
+        with span("fiddle.compile"):
+            build_cached(fname, opt)
+
     if name is None:
         name = base
 
@@ -233,53 +713,76 @@ def fiddle(fname, function=None, compile=True, name=None, code=None, opt=None, r
     else:
         return None
     
+def analyze_mtrace(trace, **kwargs):
+    # Reuse distances and hit/miss breakdown for a memory trace.  `trace` is
+    # the path to the .hdf5 file or the RenderedCode from fiddle().  See
+    # trace_analysis.analyze_trace() for the options.
+    from trace_analysis import analyze_trace
+    if isinstance(trace, RenderedCode):
+        trace = trace.mtrace
+    return analyze_trace(trace, **kwargs)
+
+
+def simulate_mtrace(trace, **kwargs):
+    # Predict cache and TLB misses for a memory trace without perf counters.
+    # Returns a one-row DataFrame with the stats CSV columns.  See
+    # trace_analysis.simulate_trace() for the options.
+    from trace_analysis import simulate_trace
+    if isinstance(trace, RenderedCode):
+        trace = trace.mtrace
+    return simulate_trace(trace, **kwargs)
+
+
 def funcs(file, funcs, *argc, **kwargs):
     for f in funcs:
 
-        display(HTML(f"<div style='text-align:center; font-weight: bold'><span>{f}</span></div>"))
+        _ipython.display(_ipython.HTML(f"<div style='text-align:center; font-weight: bold'><span>{f}</span></div>"))
         reps = build_reps(file, f, *argc, **kwargs)
-        display(reps.source)    
-        display(reps.asm)
-        display(reps.cfg)
-        display(reps.cfg_counts)
+        prefetch(reps.source, reps.asm, reps.cfg, reps.cfg_counts)
+        _ipython.display(reps.source)    
+        _ipython.display(reps.asm)
+        _ipython.display(reps.cfg)
+        _ipython.display(reps.cfg_counts)
 
 
 def side_by_side(function, *argc, **kwargs):
     data = render_czoo("czoo", function, *argc, **kwargs)
-    display(HTML("<div style='text-align:center; font-weight: bold'><span>Source</span></div>"))
-    display(data['opt'].source)    
-    display(HTML("<div style='text-align:center; font-weight: bold'><span>Unoptimized</span></div>"))
+    prefetch(*data['opt'], *data['unopt'])
+    _ipython.display(_ipython.HTML("<div style='text-align:center; font-weight: bold'><span>Source</span></div>"))
+    _ipython.display(data['opt'].source)    
+    _ipython.display(_ipython.HTML("<div style='text-align:center; font-weight: bold'><span>Unoptimized</span></div>"))
     compare([data['unopt'].asm, data['unopt'].cfg])
-    display(HTML("<div style='text-align:center; font-weight: bold'><span>Optimized</span></div>"))
+    _ipython.display(_ipython.HTML("<div style='text-align:center; font-weight: bold'><span>Optimized</span></div>"))
     compare([data['opt'].asm, data['opt'].cfg])
 
     
 def stacked(function, *argc, **kwargs):
     data = render_czoo("czoo", function, *argc, **kwargs)
-    display(HTML("<div style='text-align:center; font-weight: bold'><span>Source</span></div>"))
-    display(data['opt'].source)    
-    display(HTML("<div style='text-align:center; font-weight: bold'><span>Unoptimized</span></div>"))
-    display(data['unopt'].asm)
-    display(data['unopt'].cfg)
-    display(HTML("<div style='text-align:center; font-weight: bold'><span>Optimized</span></div>"))
-    display(data['opt'].asm)
-    display(data['opt'].cfg)
+    prefetch(*data['opt'], *data['unopt'])
+    _ipython.display(_ipython.HTML("<div style='text-align:center; font-weight: bold'><span>Source</span></div>"))
+    _ipython.display(data['opt'].source)    
+    _ipython.display(_ipython.HTML("<div style='text-align:center; font-weight: bold'><span>Unoptimized</span></div>"))
+    _ipython.display(data['unopt'].asm)
+    _ipython.display(data['unopt'].cfg)
+    _ipython.display(_ipython.HTML("<div style='text-align:center; font-weight: bold'><span>Optimized</span></div>"))
+    _ipython.display(data['opt'].asm)
+    _ipython.display(data['opt'].cfg)
 
     
 def czoo_compare2(function, *argc, **kwargs):
     file = "czoo"
     render_code(f"{file}.cpp", lang="c++", show=function),
-    display(HTML("<div style='text-align:center; font-weight: bold'><span>Unoptimized</span></div>"))
+    _ipython.display(_ipython.HTML("<div style='text-align:center; font-weight: bold'><span>Unoptimized</span></div>"))
     czoo2(function, optimize=False, *argc, **kwargs)
-    display(HTML("<div style='text-align:center; font-weight: bold'><span>Optimized</span></div>"))
+    _ipython.display(_ipython.HTML("<div style='text-align:center; font-weight: bold'><span>Optimized</span></div>"))
     czoo2(function, optimize=True, *argc, **kwargs)
 
 
 def show_png(file):
-    return Image(file)
+    return _ipython.Image(file)
 
 def display_mono(df):
-    display(df.style.set_properties(**{'font-family': 'monospace'}))
+    _ipython.display(df.style.set_properties(**{'font-family': 'monospace'}))
     
     return
 
@@ -287,7 +790,7 @@ def display_mono(df):
 def login(username):
     global user
     user = username
-    return  IFrame(f"{os.environ['DJR_SERVER']}/user/web-login?email={username}", width=500, height=400)
+    return  _ipython.IFrame(f"{os.environ['DJR_SERVER']}/user/web-login?email={username}", width=500, height=400)
 
 
 
@@ -385,7 +888,7 @@ def compare(content, headings=None):
     if headings is None:
         headings = [""] * len(content)
         
-    display(HTML("""
+    _ipython.display(_ipython.HTML("""
             <style>
         .side-by-side {
             display: flex;
@@ -420,7 +923,57 @@ def compare(content, headings=None):
     """))
 
 def render_code(*argc, **kwargs):
-    display(do_render_code(*argc, **kwargs))
+    _ipython.display(do_render_code(*argc, **kwargs))
+_symbol_indexes = {}
+
+def symbol_index(file, lang, demangle=False):
+    # The (optionally demangled) lines of file and a map from function name to
+    # the [start, end) line range do_render_code() would find for it.  Built
+    # in one pass and cached until the file changes.
+    st = os.stat(file)
+    key = (os.path.abspath(file), lang, demangle)
+    cached = _symbol_indexes.get(key)
+    if cached and cached[0] == (st.st_mtime_ns, st.st_size):
+        return cached[1], cached[2]
+
+    if demangle:
+        lines = run_async(demangle_async(file)).split("\n")
+    else:
+        with open(file) as f:
+            lines = f.read().split("\n")
+
+    index = {}
+    if lang == "c++":
+        # Functions run from "name(" to the next "}" in the first column.
+        starts = {}
+        closes = []
+        for n, l in enumerate(lines):
+            for m in re.finditer(r"[\s\*]([A-Za-z_~][\w:~]*)\s*\(", l):
+                starts.setdefault(m.group(1), n)
+            if l.startswith("}"):
+                closes.append(n)
+        for name, start in starts.items():
+            i = bisect.bisect_right(closes, start)
+            index[name] = (start, closes[i] + 1 if i < len(closes) else len(lines))
+    elif lang == "gas":
+        # Labels run to the next .cfi_endproc.
+        open_labels = []
+        for n, l in enumerate(lines):
+            if l and not l[0].isspace():
+                for i, c in enumerate(l):
+                    if c == ":" and l[:i] not in index:
+                        index[l[:i]] = None
+                        open_labels.append((l[:i], n))
+            if ".cfi_endproc" in l:
+                for name, start in open_labels:
+                    index[name] = (start, n + 1)
+                open_labels = []
+        for name, start in open_labels:
+            index[name] = (start, len(lines))
+
+    _symbol_indexes[key] = ((st.st_mtime_ns, st.st_size), lines, index)
+    return lines, index
+
 def do_render_code(file, lang="c++", show=None, line_numbers=True, trim_ends=False, demangle=None):
 
     if demangle is None:
@@ -429,16 +982,14 @@ def do_render_code(file, lang="c++", show=None, line_numbers=True, trim_ends=Fal
         else:
             demangle = False
 
-    with open(file) as f:
-        if demangle:
-            lines = subprocess.check_output('c++filt', stdin=f).decode().split("\n")
-        else:
-            lines = open(file).read().split("\n")
-        
+    lines, index = symbol_index(file, lang, demangle)
     start_line = 0
     end_line = len(lines)
 
-    if isinstance(show, str):
+    if isinstance(show, str) and show in index:
+        start_line, end_line = index[show]
+        show = None
+    elif isinstance(show, str):
         if lang == "c++":
             show = (f"[\s\*]{re.escape(show)}\s*\(", "^\}")
         elif lang == "gas":
@@ -475,40 +1026,124 @@ def do_render_code(file, lang="c++", show=None, line_numbers=True, trim_ends=Fal
     src = f"{comments.get(lang, '//')} {file}:{start_line+1}-{end_line} ({end_line-start_line} lines)\n"
     src += "\n".join(lines[start_line:end_line])
 
-    return Code(src, language=lang)
+    return _ipython.Code(src, language=lang)
 
-import pandas as pd
 
-    
-def render_csv(file, columns = None, sort_by=None, average_by=None, skip=0):
-    if isinstance(file,list):
-        pass
-    else:
-        file = [file]
+def _categorize(df):
+    for c in df.columns:
+        if not isinstance(df[c].dtype, pd.CategoricalDtype) and not pd.api.types.is_numeric_dtype(df[c]):
+            df[c] = df[c].astype("category")
+    return df
 
-    t = []
-    for f in file:
-        t += glob.glob(f)
+def _csv_cache_path(f):
+    return os.path.join(csv_cache_dir, hashlib.sha1(os.path.abspath(f).encode()).hexdigest())
 
-    file = t
-    
-    df = None
-    for f in file:
-        d = pd.read_csv(f, sep=",")
-        if df is None:
-            df = d
+def _load_cached_csv(f, st):
+    path = _csv_cache_path(f)
+    try:
+        with open(os.path.join(path, "meta.json")) as m:
+            meta = json.load(m)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != csv_cache_version or meta["mtime"] != st.st_mtime_ns or meta["size"] != st.st_size:
+        return None
+
+    columns = {}
+    for c in meta["columns"]:
+        values = np.load(os.path.join(path, f"{c['file']}.npy"), mmap_mode="r")
+        if "categories" in c:
+            values = pd.Categorical.from_codes(values, categories=c["categories"])
+        columns[c["name"]] = values
+    return pd.DataFrame(columns, columns=[c["name"] for c in meta["columns"]])
+
+def _store_cached_csv(f, st, df):
+    # One directory of .npy files per CSV, keyed by path.  It gets replaced
+    # whenever the CSV's mtime or size changes.
+    path = _csv_cache_path(f)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    columns = []
+    for i, (name, values) in enumerate(df.items()):
+        c = dict(name=name, file=f"col{i}")
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            c["categories"] = [str(x) for x in values.cat.categories]
+            values = values.cat.codes
+        np.save(os.path.join(tmp, f"{c['file']}.npy"), values.to_numpy())
+        columns.append(c)
+    with open(os.path.join(tmp, "meta.json"), "w") as m:
+        json.dump(dict(version=csv_cache_version, file=os.path.abspath(f), mtime=st.st_mtime_ns, size=st.st_size, columns=columns), m)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp, path)
+
+def read_stats_csv(f, cache=True):
+    st = os.stat(f)  # before reading, so a concurrent append invalidates the cache entry.
+    if cache:
+        with span("csv.cache_load", file=f):
+            df = _load_cached_csv(f, st)
+        if df is not None:
+            return df
+    with span("csv.parse", file=f):
+        try:
+            df = pd.read_csv(f, sep=",", dtype=pa_dtypes)
+        except (ValueError, OverflowError):
+            # Missing or negative values in a counter column.  Let pandas guess.
+            df = pd.read_csv(f, sep=",")
+        df = _categorize(df)
+    if cache:
+        with span("csv.cache_store", file=f):
+            try:
+                _store_cached_csv(f, st, df)
+            except OSError:
+                pass
+    return df
+
+@timed("render_csv")
+def render_csv(file=None, columns = None, sort_by=None, average_by=None, skip=0, cache=True, db=None, query=None):
+    if db is not None:
+        # Read from the results store (see results_db.py) instead of CSVs.
+        # `query` holds results_db.query() arguments; `file` limits it to runs
+        # ingested from matching CSVs.
+        import results_db
+        query = dict(query or {})
+        if file is not None:
+            patterns = file if isinstance(file, list) else [file]
+            where = " OR ".join(["u.source LIKE ?"]*len(patterns))
+            query['where'] = f"({where})" + (f" AND ({query['where']})" if 'where' in query else "")
+            query['params'] = [os.path.abspath(p).replace("*", "%").replace("?", "_") for p in patterns] + list(query.get('params', ()))
+        with span("render_csv.query", db=db):
+            df = _categorize(results_db.query(db, **query))
+        if df.empty:
+            raise FileNotFoundError(f"No results in {db} match {query}")
+    else:
+        if isinstance(file,list):
+            pass
         else:
-            df = df.append(d)
-            
-    df = df[skip:]
-    if sort_by:
-        df = df.sort_values(by=sort_by)
-    if average_by:
-        df = df.groupby(average_by).mean()
-        df[average_by] = df.index
-    if columns:
-        df = df[columns]
-    df.reset_index(inplace=True)
+            file = [file]
+
+        t = []
+        for f in file:
+            t += glob.glob(f)
+
+        if not t:
+            raise FileNotFoundError(f"No files match {file}")
+        file = t
+
+        # Concatenate once at the end.  Appending file by file is quadratic.
+        df = pd.concat([read_stats_csv(f, cache=cache) for f in file])
+        if len(file) > 1:
+            df = _categorize(df) # concat turns categoricals with different categories into objects.
+
+    with span("render_csv.transform"):
+        df = df[skip:]
+        if sort_by:
+            df = df.sort_values(by=sort_by)
+        if average_by:
+            df = df.groupby(average_by).mean(numeric_only=True)
+            df[average_by] = df.index
+        if columns:
+            df = df[columns]
+        df.reset_index(inplace=True)
     return df
 
 def _(csv, key, row, column, average_by=None):
@@ -516,8 +1151,6 @@ def _(csv, key, row, column, average_by=None):
     return df.filter(like="row", axis=key)[column]
     
     
-from contextlib import contextmanager
-
 @contextmanager
 def layout(subplots, columns=4):
     f = plt.figure()
@@ -538,7 +1171,6 @@ def layout(subplots, columns=4):
         plt.tight_layout()
         
 
-import matplotlib.pyplot as plt
 def plot2(file=None, df=None, field="per_element"):
     if df is None:
         df = render_csv(file)
@@ -547,6 +1179,8 @@ def plot2(file=None, df=None, field="per_element"):
     df['incremental_error'] = (df['per_element'].mean() - df['incremental_average'])/df['per_element'].mean()*100
     df['rep_error'] = (df['per_element'] - df['incremental_average'])/df['per_element'].mean()*100
     print(f"===================================\nMean = {df['per_element'].mean()}\nTotal execution time = {df['ET'].sum()}")
+    converged_at = running_stats(df['per_element']).attrs['converged_at']
+    print(f"Converged (95% CI within 1%) at rep {converged_at}" if converged_at else "Not converged (95% CI within 1%)")
 
     std = df[field].std()
     mean = df[field].mean()
@@ -599,11 +1233,66 @@ def plot2(file=None, df=None, field="per_element"):
         df["per_element"].plot.hist(ax=axs)
 
 
-def plotPE(file=None, what=None, df=None,  lines=False, columns=4, logx=None, logy=None, average=False, average_by=None, dot_size=5, combined=False, log_autoscale_x=True, log_autoscale_y=True):
-
+def summarize(df, x, ys, quantiles=(0.1, 0.5, 0.9)):
+    # One row per value of x with the mean, min, max, count and quantiles of
+    # each y, computed in one pass per statistic for all the ys together.
+    # Columns are named like "ET_mean", "ET_min", "ET_q0.9".
+    ys = [y for y in dict.fromkeys(ys) if y != x]
+    g = df.groupby(x, observed=True)[ys]
+    parts = []
+    for stat in ["mean", "min", "max", "count"]:
+        parts.append(getattr(g, stat)().add_suffix(f"_{stat}"))
+    for q in quantiles:
+        parts.append(g.quantile(q).add_suffix(f"_q{q}"))
+    s = pd.concat(parts, axis=1)
+    s[x] = s.index
+    s.reset_index(drop=True, inplace=True)
+    return s
+
+
+def lttb(x, y, n_out):
+    # Largest-Triangle-Three-Buckets downsampling: the indices of n_out points
+    # that keep the visual shape of the (x, y) line.
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    keep = [0]
+    for b in range(n_out - 2):
+        lo, hi = edges[b], edges[b + 1]
+        nlo, nhi = hi, edges[b + 2] if b + 2 < len(edges) else n
+        ax, ay = x[keep[-1]], y[keep[-1]]
+        cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        area = np.abs((ax - cx)*(y[lo:hi] - ay) - (ax - x[lo:hi])*(cy - ay))
+        keep.append(lo + int(np.argmax(area)))
+    keep.append(n - 1)
+    return np.array(keep)
+
+
+def _summaries(df, what, quantiles):
+    ys = {}
+    for x, y in what:
+        ys.setdefault(x, []).append(y)
+    return {x: summarize(df, x, y, quantiles=quantiles) for x, y in ys.items()}
+
+
+def plotPE(file=None, what=None, df=None,  lines=False, columns=4, logx=None, logy=None, average=False, average_by=None, dot_size=5, combined=False, log_autoscale_x=True, log_autoscale_y=True,
+           max_points=5000, bands=None, quantiles=(0.1, 0.5, 0.9), marks=None):
+
+    # marks: {x column: [(x value, label), ...]} draws labeled vertical lines
+    # on the subplots with that x, e.g., cache sizes or find_cliffs() output.
     if df is None:
         df = render_csv(file,average_by=average_by)
 
+    # Too many rows to scatter: draw the per-x median and a quantile band
+    # instead.  bands=True asks for that even when there aren't many rows.
+    if bands is None:
+        bands = max_points is not None and len(df) > max_points
+    summaries = _summaries(df, what, quantiles) if average or bands else None
+    low, mid, high = f"q{quantiles[0]}", f"q{quantiles[len(quantiles)//2]}", f"q{quantiles[-1]}"
+
     colors = ["blue",
               "red",
               "green",
@@ -614,7 +1303,7 @@ def plotPE(file=None, what=None, df=None,  lines=False, columns=4, logx=None, lo
     axs = None
     with layout(subplots=len(what), columns=columns) as (fig, sub):
         for i, (x, y) in enumerate(what):
-            d = df.copy()
+            d = df  # Nothing below modifies d in place, so there's no need to copy it.
             if not combined or not axs:
                 axs = next(sub)
             axs.set_ylabel(y)
@@ -637,31 +1326,47 @@ def plotPE(file=None, what=None, df=None,  lines=False, columns=4, logx=None, lo
                 axs.set_autoscaley_on(False)
                 axs.set_ybound(0, d[y].max()*1.3)
 
-                
-            if average:
-                d = d.groupby(x).mean()
-                d[x] = d.index
+            color = colors[i % len(colors)]
+            if bands:
+                s = summaries[x]
+                if max_points is not None and len(s) > max_points:
+                    s = s.iloc[lttb(s[x], s[f"{y}_{mid}"], max_points)]
+                axs.fill_between(s[x], s[f"{y}_{low}"], s[f"{y}_{high}"], color=color, alpha=0.25, linewidth=0)
+                if average:
+                    axs.scatter(s[x], s[f"{y}_mean"], s=dot_size, c=color)
+                    if lines:
+                        axs.plot(s[x], s[f"{y}_mean"], c=color)
+                else:
+                    axs.plot(s[x], s[f"{y}_{mid}"], c=color, marker="o" if not lines else None, markersize=math.sqrt(dot_size))
+            elif average:
+                d = summaries[x].rename(columns={f"{y}_mean": y})
                 #axs.plot.errorbar(x, y, yerr=1, fmt="o")
-                d.plot.scatter(y=y, x=x, ax=axs, s=dot_size, c=colors[i % len(colors)] )
+                d.plot.scatter(y=y, x=x, ax=axs, s=dot_size, c=color)
 
                 if lines:
-                    d.plot.scatter(y=y, x=x, ax=axs, c=colors[i % len(colors)] )
+                    d.plot.scatter(y=y, x=x, ax=axs, c=color)
 
             else:
-                d.plot.scatter(y=y, x=x, ax=axs, s=dot_size, c=colors[i%len(colors)])
+                d.plot.scatter(y=y, x=x, ax=axs, s=dot_size, c=color)
                 if lines:
-                    d.plot(y=y, x=x, ax=axs, c=colors[i%len(colors)])
+                    d.plot(y=y, x=x, ax=axs, c=color)
+
+            for v, label in (marks or {}).get(x, []):
+                axs.axvline(v, color="gray", linestyle="--", linewidth=0.8)
+                axs.annotate(label, xy=(v, 1), xycoords=("data", "axes fraction"), rotation=90,
+                             va="top", ha="right", fontsize=7, color="gray")
 
                 
-def plotPEBar(file=None, what=None, df=None,columns=4, log=False, average=False, average_by=None, skip=0, height=1):
+def plotPEBar(file=None, what=None, df=None,columns=4, log=False, average=False, average_by=None, skip=0, height=1, bands=False, quantiles=(0.1, 0.5, 0.9)):
     if df is None:
         df = render_csv(file,average_by=average_by)
         
+    summaries = _summaries(df, what, quantiles) if average else None
     rows = int(math.ceil(len(what)/columns))
     f = plt.figure(figsize=[4*columns, 4*rows*height], dpi = 100)
     
     for i, (x, y) in enumerate(what):
-        _df = copy.deepcopy(df)
+        _df = df
         axs = f.add_subplot(rows, columns, i+ 1)
         axs.set_ylabel(y)
         #axs.set_xlabel(x)
@@ -676,9 +1381,14 @@ def plotPEBar(file=None, what=None, df=None,columns=4, log=False, average=False,
             axs.set_autoscaley_on(False)
             
         if average:
-            _df = _df.groupby(x).mean()
-            _df[x] = _df.index
+            s = summaries[x]
+            _df = s.rename(columns={f"{y}_mean": y})
             _df.plot.bar(y=y, x=x, ax=axs)
+            if bands:
+                # Error bars from the low to the high quantile.
+                axs.errorbar(range(len(s)), s[f"{y}_mean"],
+                             yerr=[s[f"{y}_mean"] - s[f"{y}_q{quantiles[0]}"], s[f"{y}_q{quantiles[-1]}"] - s[f"{y}_mean"]],
+                             fmt="none", ecolor="black", capsize=3)
         else:
             _df.plot.bar(y=y, x=x, ax=axs)
         
@@ -688,26 +1398,881 @@ def plotPEBar(file=None, what=None, df=None,columns=4, log=False, average=False,
     plt.tight_layout()
 
             
+class CSVTail:
+    # Reads a stats CSV that is still being written, returning only the rows
+    # that have been completed since the last read().
+    def __init__(self, file):
+        self.file = file
+        self.offset = 0
+        self.columns = None
+
+    def read(self):
+        try:
+            f = open(self.file, "rb")
+        except FileNotFoundError:
+            return None
+        with f:
+            if os.fstat(f.fileno()).st_size < self.offset:
+                # The file was started over (e.g., a new run).
+                self.offset = 0
+                self.columns = None
+            f.seek(self.offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return None
+        self.offset += end
+        text = data[:end].decode()
+        if self.columns is None:
+            header, _, text = text.partition("\n")
+            self.columns = header.strip().split(",")
+        if not text.strip():
+            return None
+        return pd.read_csv(io.StringIO(text), names=self.columns, header=None)
+
+
+def live_plot(file, what, columns=4, interval=1.0, idle_timeout=30, proc=None, dot_size=5, logx=None, logy=None):
+    # Like plotPE(), but follows `file` as the benchmark appends to it.  New
+    # rows are added to the existing artists rather than redrawing
+    # everything.  Stops when `proc` (a Popen) exits, or after idle_timeout
+    # seconds without new rows.  Returns all the rows it read.
+    colors = ["blue", "red", "green", "purple", "orange", "yellow"]
+    tail = CSVTail(file)
+
+    rows = int(math.ceil(len(what)/columns))
+    fig = plt.figure(figsize=[4*columns, 4*rows])
+    axes, artists = [], []
+    for i, (x, y) in enumerate(what):
+        axs = fig.add_subplot(rows, columns, i + 1)
+        axs.set_xlabel(x)
+        axs.set_ylabel(y)
+        axs.set_title(y)
+        if logx:
+            axs.set_xscale("log", base=logx)
+        if logy:
+            axs.set_yscale("log", base=logy)
+        line, = axs.plot([], [], linestyle="", marker="o", markersize=math.sqrt(dot_size), color=colors[i % len(colors)])
+        axes.append(axs)
+        artists.append(line)
+    plt.tight_layout()
+    handle = _ipython.display(fig, display_id=True)
+    plt.close(fig)  # Otherwise Jupyter shows it again at the end of the cell.
+
+    # Growable column buffers for just the plotted columns.  Artists get
+    # views of them, so each update only copies the new rows in.
+    needed = sorted(set(c for xy in what for c in xy))
+    buffers = {c: np.empty(1024) for c in needed}
+    n = 0
+    frames = []
+    last = time.time()
+    while True:
+        finished = proc is not None and proc.poll() is not None
+        new = tail.read()
+        if new is not None and len(new):
+            frames.append(new)
+            if n + len(new) > len(buffers[needed[0]]):
+                size = max(2*len(buffers[needed[0]]), n + len(new))
+                for c in needed:
+                    b = np.empty(size)
+                    b[:n] = buffers[c][:n]
+                    buffers[c] = b
+            for c in needed:
+                buffers[c][n:n + len(new)] = new[c].to_numpy(dtype=np.float64)
+            n += len(new)
+            for (x, y), line, axs in zip(what, artists, axes):
+                line.set_data(buffers[x][:n], buffers[y][:n])
+                axs.relim()
+                axs.autoscale_view()
+            handle.update(fig)
+            last = time.time()
+        elif finished or (proc is None and time.time() - last > idle_timeout):
+            break
+        time.sleep(interval)
+
+    return pd.concat(frames, ignore_index=True) if frames else None
+
+
+def live_run(cmd, stats, what, **kwargs):
+    # Start `cmd` (which should write `stats`) and live_plot() it until it
+    # finishes.
+    if os.path.exists(stats):
+        os.remove(stats)
+    p = subprocess.Popen(cmd.split(), stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    try:
+        return live_plot(stats, what, proc=p, **kwargs)
+    finally:
+        if p.poll() is None:
+            p.kill()
+
+
 def incremental_average(d):
-    return [d[0:i+1].mean() for i in range(len(d))]
+    d = np.asarray(d, dtype=np.float64)
+    return np.cumsum(d)/np.arange(1, len(d) + 1)
+
+
+def _z_score(confidence):
+    from statistics import NormalDist
+    return NormalDist().inv_cdf(0.5 + confidence/2.0)
+
+
+def _converged_at(rel_ci, target, min_reps):
+    # First rep after which the relative CI never goes back above target.
+    # Very early reps can agree by chance, so ignore the first min_reps.
+    ok = np.minimum.accumulate((np.nan_to_num(rel_ci, nan=np.inf) <= target)[::-1])[::-1]
+    ok[:max(min_reps - 1, 0)] = False
+    hits = np.flatnonzero(ok)
+    return int(hits[0]) + 1 if len(hits) else None
+
+
+def running_stats(d, confidence=0.95, target=0.01, min_reps=5):
+    # Mean, std and confidence interval over the first N reps, for every N, in
+    # O(n).  Values are shifted by the first rep before squaring so the
+    # running sums don't cancel catastrophically for tiny per_element times.
+    x = np.asarray(d, dtype=np.float64)
+    n = np.arange(1, len(x) + 1)
+    shift = x[0] if len(x) else 0.0
+    s1 = np.cumsum(x - shift)
+    s2 = np.cumsum((x - shift)**2)
+    mean = s1/n
+    with np.errstate(invalid="ignore", divide="ignore"):
+        var = np.maximum(s2 - n*mean**2, 0)/(n - 1)
+        std = np.sqrt(var)
+        ci = _z_score(confidence)*std/np.sqrt(n)
+        mean = mean + shift
+        rel_ci = np.abs(ci/mean)
+
+    r = pd.DataFrame(dict(n=n, mean=mean, std=std, ci=ci, rel_ci=rel_ci))
+    r.attrs['converged_at'] = _converged_at(rel_ci, target, min_reps)
+    return r
+
+
+def grouped_running_stats(df, field="per_element", by=("function", "size"), confidence=0.95, target=0.01, min_reps=5):
+    # running_stats() for every group at once.  Rows stay in their original
+    # order; each row gets the statistics over the reps of its group so far.
+    by = [b for b in by if b in df.columns]
+    x = df[field].astype(np.float64)
+    g = x.groupby([df[b] for b in by], observed=True, sort=False) if by else x.groupby(np.zeros(len(x)))
+    shift = g.transform("first")
+    n = g.cumcount().to_numpy() + 1
+    s1 = (x - shift).groupby(g.ngroup()).cumsum().to_numpy()
+    s2 = ((x - shift)**2).groupby(g.ngroup()).cumsum().to_numpy()
+    mean = s1/n
+    with np.errstate(invalid="ignore", divide="ignore"):
+        std = np.sqrt(np.maximum(s2 - n*mean**2, 0)/(n - 1))
+        ci = _z_score(confidence)*std/np.sqrt(n)
+        mean = mean + shift.to_numpy()
+        rel_ci = np.abs(ci/mean)
+
+    r = df[by].copy()
+    r['n'] = n
+    r[f'{field}_mean'] = mean
+    r[f'{field}_std'] = std
+    r[f'{field}_ci'] = ci
+    r[f'{field}_rel_ci'] = rel_ci
+    r['converged'] = (rel_ci <= target) & (n >= min_reps)
+    return r
+
+
+def convergence_summary(df, field="per_element", by=("function", "size"), confidence=0.95, target=0.01, min_reps=5):
+    # One row per group: how many reps there were, the final mean/CI, and the
+    # rep after which the CI stayed below target (None if it never did).
+    stats = grouped_running_stats(df, field=field, by=by, confidence=confidence, target=target, min_reps=min_reps)
+    by = [b for b in by if b in df.columns]
+    rows = []
+    for key, s in (stats.groupby(by, observed=True, sort=False) if by else [((), stats)]):
+        key = key if isinstance(key, tuple) else (key,)
+        last = s.iloc[-1]
+        rows.append(dict(zip(by, key),
+                         reps=int(last['n']),
+                         mean=last[f'{field}_mean'],
+                         ci=last[f'{field}_ci'],
+                         rel_ci=last[f'{field}_rel_ci'],
+                         converged_at=_converged_at(s[f'{field}_rel_ci'].to_numpy(), target, min_reps)))
+    return pd.DataFrame(rows)
+
+
+def run_until_converged(cmd, stats, functions=None, field="ET", by=("function", "size"), target=0.01, confidence=0.95,
+                        batch=10, min_reps=5, max_reps=1000, quiet=True):
+    # Run a benchmark (e.g., "./fiddle.exe -l build/code.so -s 4096") in
+    # batches of `batch` reps until the confidence interval of `field` is
+    # within `target` (relative) for every group, or until max_reps.  If
+    # `functions` is given, later batches only re-run the functions that
+    # haven't converged yet.  All the reps end up in `stats`.
+    root, ext = os.path.splitext(stats)
+    batch_file = f"{root}.batch{ext}"
+    import results_db
+    metadata = results_db.run_metadata()
+    if isinstance(functions, str):
+        functions = [functions]
+    remaining = list(functions) if functions else None
+
+    frames = []
+    reps = 0
+    summary = None
+    while reps < max_reps:
+        n = min(batch, max_reps - reps)
+        c = f"{cmd} -r {n} -o {batch_file}"
+        if remaining:
+            c += f" -f {' '.join(remaining)}"
+        if not get_backend().run([c], quiet=quiet)[0].ok:
+            raise Exception(f"'{c}' failed.")
+        frames.append(read_stats_csv(batch_file, cache=False))
+        reps += n
+
+        df = _categorize(pd.concat(frames, ignore_index=True))
+        if field == "per_element" and field not in df.columns:
+            df[field] = df['ET']/df['size']
+        summary = convergence_summary(df, field=field, by=by, confidence=confidence, target=target, min_reps=min_reps)
+        done = (summary['rel_ci'] <= target) & (summary['reps'] >= min_reps)
+        print(f"{reps} reps: {done.sum()}/{len(done)} converged; worst {field} CI is {summary['rel_ci'].max()*100:.2f}%")
+        if done.all():
+            break
+        if remaining and "function" in summary.columns:
+            remaining = [f for f in remaining if not done[summary['function'] == f].all()]
+            if not remaining:
+                break
+
+    os.remove(batch_file)
+    df.to_csv(stats, index=False)
+    results_db.record(stats, metadata, kind="run_until_converged", cmd=cmd)
+    df.attrs['convergence'] = summary
+    return df
+
+
+fiddle_flags = dict(size="-s", tile_size="-t", arg1="-a", function="-f", mhz="-M", reps="-r", iterations="-i", lib="-l")
+
+
+def sweep(cmd, grid, stats, policy="exclusive", workers=None, cores=None, tags=None):
+    # Run `cmd` (e.g., "./fiddle.exe -l build/code.so") once for every point
+    # in `grid`, a dict from parameter name (see fiddle_flags) to a list of
+    # values, across a pool of workers that are each pinned to their own
+    # core.  With policy="oversubscribe", runs share cores, so only use the
+    # results to check correctness.  The per-run CSVs are merged into
+    # `stats`, which is recorded in the results store along with `tags`.
+    import itertools
+    import results_db
+    metadata = results_db.run_metadata()
+
+    names = list(grid.keys())
+    points = [dict(zip(names, v)) for v in itertools.product(*[grid[n] if isinstance(grid[n], (list, tuple, range)) else [grid[n]] for n in names])]
+
+    root, ext = os.path.splitext(stats)
+    out_dir = f"{root}.sweep"
+    os.makedirs(out_dir, exist_ok=True)
+
+    outs, cmds = [], []
+    for i, point in enumerate(points):
+        outs.append(os.path.join(out_dir, f"{i:04}{ext}"))
+        args = cmd.split() + ["-o", outs[-1]]
+        for n, v in point.items():
+            args += [fiddle_flags.get(n, n)] + [str(x) for x in (v if isinstance(v, (list, tuple)) else [v])]
+        cmds.append(args)
+
+    # The current backend, if it's a LocalBackend with the same placement,
+    # has its workers running already.
+    backend = get_backend()
+    if not (isinstance(backend, LocalBackend) and backend.policy == policy and workers in (None, backend.workers)
+            and cores in (None, backend.cores)):
+        backend = LocalBackend(workers=workers, policy=policy, cores=cores)
+    print(f"Running {len(points)} configurations on {backend.workers} workers (cores {sorted(set(backend.cores[:backend.workers]))})")
+    try:
+        with span("sweep.run", points=len(points), workers=backend.workers):
+            results = backend.run(cmds)
+    finally:
+        if backend is not get_backend():
+            backend.close()
+
+    frames = []
+    for args, out, r in zip(cmds, outs, results):
+        if not r.ok:
+            raise Exception(f"'{' '.join(args)}' failed on core {r.core}.")
+        df = read_stats_csv(out, cache=False)
+        df['core'] = r.core
+        frames.append(df)
+
+    df = _categorize(pd.concat(frames, ignore_index=True))
+    df['exclusive'] = policy == "exclusive"
+    df.to_csv(stats, index=False)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    results_db.record(stats, metadata, **dict(dict(kind="sweep", cmd=cmd), **(tags or {})))
+    return df
+
+
+# Tile-size autotuning for the convolution_tiled* functions.  A search is a
+# coarse sweep over powers of two followed by a finer one around the
+# winner.  Each is a race: every candidate tile size runs in one fiddle.exe
+# invocation, `batch` reps at a time, and a candidate drops out as soon as
+# its confidence interval is entirely slower than the leader's.  The winner
+# is cached per CPU model in tuning_cache.
+tuning_cache = os.path.join(str(Path.home()), ".cache", "fiddle-tuning.json")
+
+# Functions that ignore tile_size, and the tile they really use.
+fixed_tile_functions = dict(convolution_tiled_fixed_tile=64)
+# Functions that need tile_size to be a multiple of 8.
+split_tile_functions = ["convolution_tiled_split"]
+
+
+def cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for l in f:
+                if l.startswith("model name"):
+                    return l.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    import platform
+    return platform.processor() or platform.machine()
+
+
+def _race(cmd, tiles, field="ET", batch=3, target=0.02, confidence=0.95, max_reps=30, quiet=True):
+    # Race `tiles` against each other.  Returns one row per tile size with
+    # the mean, relative CI, reps it got, and whether it was still in the
+    # running at the end.
+    out = os.path.join("build", f".race.{os.getpid()}.csv")
+    os.makedirs("build", exist_ok=True)
+    z = _z_score(confidence)
+    alive = sorted(set(tiles))
+    frames = []
+    eliminated = {}
+    rounds = 0
+    while alive and rounds*batch < max_reps:
+        c = f"{cmd} -t {' '.join(str(t) for t in alive)} -r {batch} -o {out}"
+        if not get_backend().run([c], quiet=quiet)[0].ok:
+            raise Exception(f"'{c}' failed.")
+        frames.append(read_stats_csv(out, cache=False))
+        rounds += 1
+
+        df = pd.concat(frames, ignore_index=True)
+        g = df[df['tile_size'].isin(alive)].groupby("tile_size")[field]
+        stats = pd.DataFrame(dict(mean=g.mean(), half=z*g.std()/np.sqrt(g.count())))
+        best = stats['mean'].idxmin()
+        if rounds*batch >= 2:
+            slower = stats.index[stats['mean'] - stats['half'] > stats.loc[best, 'mean'] + stats.loc[best, 'half']]
+            for t in slower:
+                eliminated[t] = rounds*batch
+            alive = [t for t in alive if t not in eliminated]
+            if len(alive) == 1 or (stats.loc[alive, 'half']/stats.loc[alive, 'mean'] <= target).all():
+                break
+    os.remove(out)
+
+    df = pd.concat(frames, ignore_index=True)
+    g = df.groupby("tile_size")[field]
+    result = pd.DataFrame({field: g.mean(), "rel_ci": z*g.std()/np.sqrt(g.count())/g.mean(), "reps": g.count()})
+    result['alive'] = [t in alive for t in result.index]
+    return result.reset_index()
+
+
+def _refinements(best, low, high, step):
+    # Tile sizes between best's neighbors in the coarse sweep.
+    lo = max(low, best//2)
+    hi = min(high, best*2)
+    n = 8
+    return sorted({max(step, int(round((lo + (hi - lo)*i/n)/step))*step) for i in range(n + 1)})
+
+
+def autotune_tile(function, size, kernel_size, lib="build/convolution.so", cmd=None, field="ET",
+                  batch=3, target=0.02, confidence=0.95, max_reps=30, refine=True, use_cache=True, quiet=True):
+    # Find the fastest tile_size for `function` convolving a `size`-element
+    # source with a `kernel_size`-element kernel.  Build `lib` with fiddle()
+    # first.  Returns dict(tile_size=..., field=..., results=DataFrame of
+    # every tile size tried), and caches the answer for this CPU model and
+    # build of lib.
+    if function in fixed_tile_functions:
+        print(f"{function} ignores tile_size (it always uses {fixed_tile_functions[function]}).")
+        return dict(tile_size=fixed_tile_functions[function], results=None)
+    if cmd is None:
+        cmd = f"./fiddle.exe -l {lib}"
+    cmd = f"{cmd} -f {function} -s {size} -a {kernel_size}"
+
+    model = cpu_model()
+    key = f"{function} size={size} kernel_size={kernel_size} field={field} lib={_file_hash(lib) if os.path.exists(lib) else lib}"
+    cache = {}
+    if use_cache and os.path.exists(tuning_cache):
+        with open(tuning_cache) as f:
+            cache = json.load(f)
+        if key in cache.get(model, {}):
+            print(f"Using the cached tile size for {model}")
+            return dict(cache[model][key], results=None)
+
+    step = 8 if function in split_tile_functions else 1
+    high = max(step, int(kernel_size)//step*step)
+    coarse = []
+    t = step
+    while t < high:
+        coarse.append(t)
+        t *= 2
+    coarse.append(high)
+
+    race = lambda tiles: _race(cmd, tiles, field=field, batch=batch, target=target, confidence=confidence,
+                               max_reps=max_reps, quiet=quiet)
+    with span("autotune.coarse", function=function):
+        results = race(coarse)
+    best = int(results.loc[results[field].idxmin(), 'tile_size'])
+    if refine:
+        tiles = [t for t in _refinements(best, step, high, step) if t not in set(results['tile_size'])]
+        if tiles:
+            with span("autotune.refine", function=function):
+                fine = race(tiles + [best])
+            results = pd.concat([results[results['tile_size'] != best], fine], ignore_index=True).sort_values("tile_size")
+            best = int(results.loc[results[field].idxmin(), 'tile_size'])
+
+    answer = {"tile_size": best, field: float(results.loc[results['tile_size'] == best, field].iloc[0])}
+    print(f"Best tile_size for {function} (size={size}, kernel_size={kernel_size}): {best} "
+          f"({len(results)} sizes tried, {int(results['reps'].sum())} reps)")
+    if use_cache:
+        cache.setdefault(model, {})[key] = answer
+        os.makedirs(os.path.dirname(tuning_cache), exist_ok=True)
+        with open(f"{tuning_cache}.{os.getpid()}.tmp", "w") as f:
+            json.dump(cache, f, indent=2)
+        os.rename(f"{tuning_cache}.{os.getpid()}.tmp", tuning_cache)
+    return dict(answer, results=results.reset_index(drop=True))
+
+
+# Derived metrics, evaluated with DataFrame.eval().  `agg` says how to combine
+# rows: "sum", "mean", "hmean" (for rates), or ("wmean", weight) for ratios,
+# which gives the ratio of the sums, e.g., total misses per total instruction.
+# @element_bytes is the size of one element of `size` (the element_bytes
+# argument of derive_metrics() and aggregate_metrics()).
+Metric = namedtuple("Metric", "expr agg")
+derived_metrics = dict(
+    L1_MPKI=Metric("L1_cache_misses / IC * 1000", ("wmean", "IC")),
+    TLB_MPKI=Metric("TLB_misses / IC * 1000", ("wmean", "IC")),
+    L1_dcache_MPKI=Metric("L1_dcache_misses / IC * 1000", ("wmean", "IC")),
+    cycles=Metric("IC * CPI", "sum"),
+    ET_model=Metric("IC * CPI * CT", "sum"),
+    ET_model_error=Metric("(ET - IC * CPI * CT) / ET", "mean"),
+    per_element=Metric("ET / size", ("wmean", "size")),
+    IC_per_element=Metric("IC / size", ("wmean", "size")),
+    bytes_per_cycle=Metric("size * @element_bytes / (IC * CPI)", ("wmean", "IC * CPI")),
+    MHz=Metric("1 / CT / 1e6", "hmean"),
+)
+
+# How to combine the measured columns.
+column_aggregations = dict(IC="sum", ET="sum", L1_cache_misses="sum", TLB_misses="sum",
+                           Cycles="sum", L1_dcache_misses="sum", L1_dcache_accesses="sum",
+                           CPI=("wmean", "IC"), CT="mean", L1_MPI=("wmean", "IC"), TLB_MPI=("wmean", "IC"),
+                           L1_dcache_miss_rate=("wmean", "L1_dcache_accesses"),
+                           cmdlineMHz="mean", realMHz="mean")
+
+
+def _can_eval(df, expr):
+    names = set(re.findall(r"(?<![\w.@])[A-Za-z_]\w*", expr))
+    return names <= set(df.columns)
+
+
+def derive_metrics(df, metrics=None, element_bytes=8):
+    # Add a column for each metric (by name, from derived_metrics, or a dict
+    # of Metrics) that df has the inputs for.  element_bytes is the size of
+    # the elements `size` counts (8 for the uint64_t arrays fiddle.exe makes).
+    if metrics is None:
+        metrics = derived_metrics
+    elif not isinstance(metrics, dict):
+        metrics = {m: derived_metrics[m] for m in metrics}
+    df = df.copy()
+    for name, m in metrics.items():
+        if _can_eval(df, m.expr):
+            df[name] = df.eval(m.expr, local_dict=dict(element_bytes=element_bytes)).astype(np.float64)
+    return df
+
+
+def aggregate_metrics(df, by=("function", "size"), metrics=None, aggregations=None, element_bytes=8):
+    # Combine the rows of each group with the right aggregation for each
+    # column.  Measured columns use column_aggregations (or `aggregations`);
+    # derived metrics are added first and use their own.
+    if metrics is None:
+        metrics = derived_metrics
+    elif not isinstance(metrics, dict):
+        metrics = {m: derived_metrics[m] for m in metrics}
+    aggs = dict(column_aggregations)
+    aggs.update({name: m.agg for name, m in metrics.items()})
+    if aggregations:
+        aggs.update(aggregations)
+
+    df = derive_metrics(df, metrics, element_bytes=element_bytes)
+    by = [b for b in by if b in df.columns]
+    keys = [df[b] for b in by]
+    columns = [c for c in aggs if c in df.columns and c not in by]
+
+    g = lambda x: x.groupby(keys, observed=True)
+    result = {}
+    for c in columns:
+        agg = aggs[c]
+        x = df[c].astype(np.float64)
+        if agg == "sum":
+            result[c] = g(x).sum()
+        elif agg == "mean":
+            result[c] = g(x).mean()
+        elif agg == "hmean":
+            result[c] = g(x).count()/g(1.0/x).sum()
+        elif isinstance(agg, tuple) and agg[0] == "wmean":
+            if not _can_eval(df, agg[1]):
+                continue
+            w = df.eval(agg[1]).astype(np.float64)
+            result[c] = g(x*w).sum()/g(w).sum()
+        else:
+            raise ValueError(f"Unknown aggregation {agg} for {c}")
+    result = pd.DataFrame(result)
+    result['reps'] = g(df[columns[0]] if columns else df.iloc[:, 0]).size()
+    return result.reset_index()
 
 
 def IC_avg_and_combine(*argc):
-    all = render_csv(argc[0])
-    all = all[0:0]
-
-    for f in argc:
-        df = render_csv(f)
-        t = df['function'][0]
-        r = dict(function=df['function'][0],
-                 IC=df['IC'].sum(),
-                 CPI=df['CPI'].mean(),
-                 CT=df['CT'].mean(),
-                 ET=df['ET'].sum(),
-                 cmdlineMHz=df['cmdlineMHz'].mean(),
-                 realMHz=df['realMHz'].mean())
-        all = all.append(r, ignore_index=True)
-
-    return all
-
-print("Done loading notebook! We're good to go!");
+    # One row per file (and function in it), in argument order.
+    df = pd.concat([render_csv(f).assign(source=f) for f in argc], ignore_index=True)
+    df['source'] = pd.Categorical(df['source'], categories=list(dict.fromkeys(argc)), ordered=True)
+    return aggregate_metrics(_categorize(df), by=("source", "function"), metrics={},
+                             aggregations=dict(CPI="mean"))[["source", "function", "IC", "CPI", "CT", "ET", "cmdlineMHz", "realMHz"]]
+
+
+# Scaling curves for the join: sweep one table dimension at a time
+# geometrically (the others stay at the autograde configuration) past the
+# caches and TLB reach, and look for the sizes where per-element cost jumps.
+join_base_config = dict(customers=2048, products=4096, brands=64)
+
+# Bytes of working set per unit of each dimension, for placing cache sizes
+# on the x axis.  products is sizeof(product) from table_struct.h; the
+# others depend on the solution's data structures, so they're left out.
+join_element_bytes = dict(products=24)
+
+
+def cache_capacities():
+    # {name: bytes} for this host's data caches (from sysfs) and TLB reach:
+    # measured by characterize_tlb() if we've run it on this CPU, otherwise
+    # that of the TLBs the simulator in trace_analysis.py models.
+    caps = {}
+    for d in sorted(glob.glob("/sys/devices/system/cpu/cpu0/cache/index*")):
+        try:
+            with open(f"{d}/type") as f:
+                kind = f.read().strip()
+            with open(f"{d}/level") as f:
+                level = f.read().strip()
+            with open(f"{d}/size") as f:
+                size = f.read().strip()
+        except OSError:
+            continue
+        if kind == "Instruction":
+            continue
+        units = dict(K=1024, M=1024**2, G=1024**3)
+        caps[f"L{level}{'d' if kind == 'Data' else ''}"] = int(size[:-1])*units[size[-1]] if size[-1] in units else int(size)
+    profile = machine_profile()
+    if profile and profile.get("l1_dtlb_entries"):
+        caps["TLB reach"] = int(profile["l1_dtlb_entries"]*4096)
+        caps["STLB reach"] = int(profile["l2_dtlb_entries"]*4096)
+    else:
+        from trace_analysis import default_tlbs
+        for t in default_tlbs:
+            caps[f"{t.name} reach"] = t.sets*t.ways*t.block_size
+    return caps
+
+
+def find_cliffs(df, x, y, threshold=1.25):
+    # The steps where the median of y jumps by at least `threshold` times
+    # from one x to the next.  Each cliff is placed at the geometric middle
+    # of the two x values.
+    m = df.groupby(x)[y].median().sort_index()
+    ratio = m.values[1:]/m.values[:-1]
+    i = np.nonzero(ratio >= threshold)[0]
+    return pd.DataFrame({x: np.sqrt(m.index.values[i]*m.index.values[i + 1]).astype(np.float64),
+                         "before": m.values[i], "after": m.values[i + 1], "ratio": ratio[i]})
+
+
+def _mpi_columns(df):
+    # Misses per instruction, from the raw counts if join.exe didn't report them.
+    df = df.copy()
+    for mpi, misses in [("L1_MPI", ["L1_cache_misses", "L1_dcache_misses"]), ("TLB_MPI", ["TLB_misses"])]:
+        if mpi not in df.columns:
+            for m in misses:
+                if m in df.columns and "IC" in df.columns:
+                    df[mpi] = df[m].astype(np.float64)/df["IC"]
+                    break
+    return df
+
+
+def join_rows(df):
+    # What per_element divides ET by.  If join.exe reports how many orders it
+    # made (an `orders` column), that's the rows the join reads: all the
+    # orders plus the product table.  It doesn't today, and how many orders
+    # it makes per customer is up to its own generator, so otherwise it's
+    # just `customers`, which the order count grows with.  per_element is
+    # then ET per customer: the customers sweep shows the cost per unit of
+    # work, and the products and brands sweeps, where it's constant, show ET
+    # scaled.
+    if "orders" in df.columns:
+        return (df["orders"] + df["products"]).astype(np.float64)
+    return df["customers"].astype(np.float64)
+
+
+def join_scaling(cmd="./join.exe -M 3300 -i 1", stats="join_scaling.csv", functions=("join_solution_c",),
+                 dimensions=("customers", "products", "brands"), base=None, factor=2, steps=10, reps=None,
+                 policy="exclusive", workers=1):
+    # For each dimension, run `functions` at base[dimension]*factor**k for k
+    # in 0..steps-1 via sweep().  Returns {dimension: DataFrame} with `rows`
+    # (join_rows()) and a per_element column (ET/rows); the CSVs go in
+    # stats-<dimension>.csv.  One worker by default, since concurrent runs
+    # share the L3 and memory bandwidth these curves are about.
+    base = dict(join_base_config, **(base or {}))
+    root, ext = os.path.splitext(stats)
+    cmd = f"{cmd} -f {' '.join(functions)}"
+    if reps:
+        cmd += f" -r {reps}"
+    results = {}
+    for dim in dimensions:
+        grid = {f"-{k}": v for k, v in base.items()}
+        grid[f"-{dim}"] = [int(base[dim]*factor**k) for k in range(steps)]
+        df = _mpi_columns(sweep(cmd, grid, f"{root}-{dim}{ext}", policy=policy, workers=workers,
+                                tags=dict(kind="join_scaling", dimension=dim)))
+        df["rows"] = join_rows(df)
+        df["per_element"] = df["ET"]/df["rows"]
+        results[dim] = df
+    return results
+
+
+def fit_join_scaling(results):
+    # For each dimension and function, fit median ET = fixed + per_row*rows
+    # (see join_rows()) by least squares, and the slope of log ET against
+    # log dimension (`exponent`).  rel_rms is how far the linear fit is off;
+    # when it's large, the cost per row isn't constant, and find_cliffs() can
+    # say where it changes.  Where rows doesn't change across the sweep,
+    # there's no linear fit and only the exponent is filled in.
+    fits = []
+    for dim, df in results.items():
+        for f, d in df.groupby("function", observed=True):
+            m = d.groupby(dim).agg(ET=("ET", "median"), rows=("rows", "first")).reset_index()
+            if len(m) < 2:
+                continue
+            exponent = np.polyfit(np.log(m[dim].astype(np.float64)), np.log(m["ET"]), 1)[0]
+            fixed = per_row = rel_rms = np.nan
+            if m["rows"].nunique() > 1:
+                (per_row, fixed), *_ = np.linalg.lstsq(np.column_stack([m["rows"], np.ones(len(m))]), m["ET"], rcond=None)
+                predicted = fixed + per_row*m["rows"]
+                rel_rms = float(np.sqrt(np.mean(((m["ET"] - predicted)/m["ET"])**2)))
+            fits.append(dict(dimension=dim, function=f, exponent=exponent, fixed=fixed, per_row=per_row, rel_rms=rel_rms))
+    return pd.DataFrame(fits, columns=["dimension", "function", "exponent", "fixed", "per_row", "rel_rms"])
+
+
+def plot_join_scaling(results, threshold=1.25, element_bytes=None, columns=4):
+    # One row of plots per dimension: per_element, L1_MPI and TLB_MPI against
+    # its size, with the cliffs find_cliffs() sees in per_element and, where
+    # element_bytes says how big an element is, the cache sizes.  Returns the
+    # cliffs as a DataFrame; `at` is the size of the dimension at the cliff.
+    if element_bytes is None:
+        element_bytes = join_element_bytes
+    caps = cache_capacities()
+    cliffs = []
+    for dim, df in results.items():
+        c = find_cliffs(df, dim, "per_element", threshold=threshold)
+        c.insert(0, "dimension", dim)
+        if dim in element_bytes and len(c):
+            # The largest cache the working set had just outgrown.
+            footprint = c[dim]*element_bytes[dim]
+            c["outgrew"] = [max([(v, k) for k, v in caps.items() if v <= f], default=(0, None))[1] for f in footprint]
+        marks = [(v, f"{r:.2g}x") for v, r in zip(c[dim], c["ratio"])]
+        cliffs.append(c.rename(columns={dim: "at"}))
+        if dim in element_bytes:
+            marks += [(v/element_bytes[dim], k) for k, v in caps.items()
+                      if df[dim].min() <= v/element_bytes[dim] <= df[dim].max()]
+        what = [(dim, y) for y in ["per_element", "L1_MPI", "TLB_MPI"] if y in df.columns]
+        plotPE(df=df, what=what, logx=2, logy=10, columns=columns, average=True, lines=True, marks={dim: marks})
+    return pd.concat(cliffs, ignore_index=True) if cliffs else None
+
+# TLB characterization with the pointer-chasing kernels in TLB.cpp.  With a
+# 4160-byte stride every access lands on its own 4KB page (and a different
+# cache set), so as the footprint grows past each TLB level's reach the cost
+# per access steps up.  For a random walk over N pages and a TLB with E
+# entries, about 1 - E/N of accesses miss, so we fit
+#
+#   cycles/access = base + l2_hit*max(0, 1 - E1/N) + walk*max(0, 1 - E2/N)
+#
+# The other strides are for comparison: TLB_8 walks within pages (cache
+# misses, few TLB misses), TLB_4096 puts every access in the same cache set,
+# and TLB_2M touches a new 2MB page every access.  The _huge versions ask
+# for transparent huge pages, which gives the huge-page benefit at the same
+# footprints.
+#
+# Each footprint runs at two access counts, and the cost per access comes
+# from the difference in Cycles, so building and shuffling the list drops
+# out.
+machine_profile_file = os.path.join(str(Path.home()), ".cache", "fiddle-machine-profile.json")
+
+tlb_stride = 4160
+
+# Stride in bytes of each kernel in TLB.cpp.
+tlb_kernels = dict(TLB_8=8, TLB_4096=4096, TLB_4160=4160, TLB_2M=2*1024*1024 + 64,
+                   TLB_4096_huge=4096, TLB_4160_huge=4160, TLB_2M_huge=2*1024*1024 + 64)
+
+
+def machine_profile(model=None):
+    # The saved profile for this CPU model (or `model`), or None.
+    if not os.path.exists(machine_profile_file):
+        return None
+    with open(machine_profile_file) as f:
+        return json.load(f).get(model or cpu_model())
+
+
+def save_machine_profile(profile, model=None):
+    profiles = {}
+    if os.path.exists(machine_profile_file):
+        with open(machine_profile_file) as f:
+            profiles = json.load(f)
+    profiles[model or cpu_model()] = profile
+    os.makedirs(os.path.dirname(machine_profile_file), exist_ok=True)
+    with open(f"{machine_profile_file}.{os.getpid()}.tmp", "w") as f:
+        json.dump(profiles, f, indent=2)
+    os.rename(f"{machine_profile_file}.{os.getpid()}.tmp", machine_profile_file)
+
+
+def _tlb_pages(function, size):
+    # 4KB pages a kernel's footprint covers (and so, for strides of a page or
+    # more, one per element).
+    return size/max(tlb_kernels.get(function, tlb_stride), 4096)
+
+
+def _tlb_costs(df):
+    # Cycles per access for each function and footprint, from the difference
+    # between the medians at its longest and shortest access counts (arg1),
+    # plus pages touched and TLB misses per access where fiddle.exe counted
+    # them.
+    df = df.copy()
+    df.attrs = {}  # run_until_converged()'s summary would follow the result into every merge.
+    if "Cycles" in df.columns:
+        df["cycles"] = df["Cycles"].astype(np.float64)
+    else:
+        df["cycles"] = df["ET"]/df["CT"]
+    columns = ["cycles"]
+    if "TLB_misses" in df.columns:
+        df["misses"] = df["TLB_misses"].astype(np.float64)
+        columns.append("misses")
+    m = df.groupby(["function", "size", "arg1"], observed=True)[columns].median().reset_index()
+    g = m.groupby(["function", "size"], observed=True)["arg1"]
+    short = m.loc[g.idxmin()].set_index(["function", "size"])
+    long = m.loc[g.idxmax()].set_index(["function", "size"])
+    accesses = (long["arg1"] - short["arg1"]).astype(np.float64)
+    if (accesses <= 0).any():
+        raise ValueError("Each footprint needs runs at two different access counts (arg1).")
+    costs = pd.DataFrame(dict(accesses=accesses, cycles_per_access=(long["cycles"] - short["cycles"])/accesses))
+    if "misses" in columns:
+        costs["TLB_MPA"] = (long["misses"] - short["misses"])/accesses
+    costs = costs.reset_index()
+    costs.insert(2, "pages", [_tlb_pages(f, s) for f, s in zip(costs["function"], costs["size"])])
+    return costs
+
+
+def fit_tlb(pages, cycles, candidates=64):
+    # Fit the two-level model above by trying every pair of entry counts on a
+    # geometric grid and solving for the costs by least squares.  Returns
+    # dict(l1_dtlb_entries, l2_dtlb_entries, base_cycles, l2_hit_cycles,
+    # page_walk_cycles, rms_error).
+    pages = np.asarray(pages, dtype=np.float64)
+    cycles = np.asarray(cycles, dtype=np.float64)
+    grid = np.geomspace(pages.min(), pages.max(), candidates)
+    h = lambda e: np.maximum(0.0, 1.0 - e/pages)
+    best = None
+    for i, e1 in enumerate(grid):
+        for e2 in grid[i + 1:]:
+            X = np.column_stack([np.ones_like(pages), h(e1), h(e2)])
+            coef, *_ = np.linalg.lstsq(X, cycles, rcond=None)
+            if (coef < 0).any():
+                continue
+            err = np.sum((X @ coef - cycles)**2)
+            if best is None or err < best[0]:
+                best = (err, e1, e2, coef)
+    if best is None:
+        raise ValueError("Couldn't fit the TLB model.  Try a wider range of footprints.")
+    err, e1, e2, coef = best
+    return dict(l1_dtlb_entries=int(round(e1)), l2_dtlb_entries=int(round(e2)), base_cycles=float(coef[0]),
+                l2_hit_cycles=float(coef[1]), page_walk_cycles=float(coef[2]), rms_error=float(np.sqrt(err/len(pages))))
+
+
+def _build_fiddle_lib(lib):
+    # Build fiddle.exe and lib (build/X.so, from X.cpp in this directory).
+    src = f"{os.path.splitext(os.path.basename(lib))[0]}.cpp"
+    target = f"{os.path.splitext(lib)[0]}.cpp"
+    if os.path.exists(src):
+        os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+        if not os.path.exists(target) or _sha256(src) != _sha256(target):
+            shutil.copy(src, target)
+        if not build_cached(target):
+            raise Exception(f"Couldn't build {lib}.")
+    elif not os.path.exists(lib):
+        raise FileNotFoundError(f"There's no {lib}, and no {src} to build it from.")
+    if not shell_cmd("make fiddle.exe", quiet_on_success=True):
+        raise Exception("Couldn't build fiddle.exe.")
+
+
+def characterize_tlb(lib="build/TLB.so", cmd=None, stats="tlb_characterization.csv", min_pages=4, max_pages=16384,
+                     steps_per_octave=4, max_bytes=2**28, accesses=2**22, functions=None, target=0.02, max_reps=20,
+                     save=True, quiet=True):
+    # Run the kernels in tlb_kernels (or `functions`) over footprints from
+    # min_pages to max_pages pages (elements, for strides past a page), up
+    # to max_bytes, each at `accesses` and 2*accesses accesses.  Then fit
+    # the model to TLB_4160 and (with save) store the result as this CPU's
+    # machine profile.  Without `cmd`, fiddle.exe and lib (from the .cpp of
+    # the same name, e.g. TLB.cpp) are built first.  Returns the profile;
+    # the per-footprint costs are in profile["costs"] and the raw reps in
+    # `stats`.
+    if cmd is None:
+        _build_fiddle_lib(lib)
+        cmd = f"./fiddle.exe -l {lib}"
+    if functions is None:
+        functions = list(tlb_kernels)
+    octaves = math.log2(max_pages/min_pages)
+    pages = [min_pages*2**(k/steps_per_octave) for k in range(int(octaves*steps_per_octave) + 1)]
+
+    # Kernels with the same stride share a list of sizes.
+    by_stride = {}
+    for f in functions:
+        by_stride.setdefault(tlb_kernels[f], []).append(f)
+    frames = []
+    with span("tlb.measure"):
+        for stride, fs in by_stride.items():
+            unit = max(stride, 4096)
+            sizes = sorted({int(unit*p) for p in pages if unit*p <= max_bytes})
+            if not sizes:
+                continue
+            # One access count per run: fiddle.exe also uses the -a values
+            # as the sizes2 list, so passing both would run everything twice.
+            for n in [accesses, 2*accesses]:
+                df = run_until_converged(f"{cmd} -s {' '.join(str(s) for s in sizes)} -a {n}", stats,
+                                         functions=fs, field="ET", by=("function", "size"), target=target,
+                                         batch=3, min_reps=3, max_reps=max_reps, quiet=quiet)
+                df.attrs = {}  # pd.concat() can't compare the convergence summaries.
+                frames.append(df)
+    df = pd.concat(frames, ignore_index=True)
+    df.to_csv(stats, index=False)
+    costs = _tlb_costs(df)
+
+    small = costs[costs["function"] == "TLB_4160"]
+    if small.empty:
+        raise ValueError("The TLB model is fit to TLB_4160, so `functions` has to include it.")
+    huge = costs[costs["function"] == "TLB_4160_huge"]
+    with span("tlb.fit"):
+        profile = fit_tlb(small["pages"], small["cycles_per_access"])
+
+    # Huge-page benefit, at the footprints past the 4KB STLB's reach.
+    both = small.merge(huge, on="size", suffixes=("", "_huge"))
+    big = both[both["pages"] > profile["l2_dtlb_entries"]]
+    if len(big):
+        profile["huge_page_speedup"] = float((big["cycles_per_access"]/big["cycles_per_access_huge"]).median())
+        profile["huge_page_cycles_saved"] = float((big["cycles_per_access"] - big["cycles_per_access_huge"]).median())
+    profile.update(cpu_model=cpu_model(), host=os.uname().nodename, measured=time.strftime("%Y-%m-%d %H:%M:%S"),
+                   accesses=accesses, caches={k: v for k, v in cache_capacities().items() if "reach" not in k})
+    print(f"L1 dTLB ~{profile['l1_dtlb_entries']:.0f} entries, L2 dTLB ~{profile['l2_dtlb_entries']:.0f} entries, "
+          f"L2 TLB hit ~{profile['l2_hit_cycles']:.1f} cycles, page walk ~{profile['page_walk_cycles']:.1f} cycles"
+          + (f", huge pages {profile['huge_page_speedup']:.2f}x faster" if "huge_page_speedup" in profile else ""))
+    if save:
+        save_machine_profile(profile)
+    profile["costs"] = costs
+    return profile
+
+
+def plot_tlb(profile, columns=4):
+    # Cycles (and TLB misses) per access vs. pages touched for each kernel,
+    # with the fitted TLB sizes marked.
+    costs = profile["costs"]
+    marks = {"pages": [(profile["l1_dtlb_entries"], "L1 dTLB"), (profile["l2_dtlb_entries"], "L2 dTLB")]}
+    for f, d in costs.groupby("function", observed=True):
+        what = [("pages", y) for y in ["cycles_per_access", "TLB_MPA"] if y in d.columns]
+        plotPE(df=d, what=what, logx=2, columns=columns, lines=True, marks=marks)
+
+
+print("Done loading notebook! Call setup() once per kernel to finish setting up. We're good to go!");
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# Find performance regressions by comparing the reps of a new run against a
+# baseline, per function and configuration.
+#
+# A group is flagged when a one-sided Mann-Whitney test says the new reps are
+# slower (or faster) than the baseline's and the median moved by more than
+# min_change.  Since ET = IC * CPI * CT, the log of the ET ratio splits into
+# the logs of the IC, CPI and CT ratios, which tells us whether the code now
+# does more work, runs it less efficiently, or the clock changed.
+
+import math
+import click
+import numpy as np
+import pandas as pd
+
+group_keys = ["function", "size", "customers", "products", "brands"]
+
+
+def _ranks(x):
+    # Ranks starting at 1, with ties sharing their average rank.
+    order = np.argsort(x, kind="mergesort")
+    ranks = np.empty(len(x))
+    ranks[order] = np.arange(1, len(x) + 1)
+    _, inverse, counts = np.unique(x, return_inverse=True, return_counts=True)
+    return (np.bincount(inverse, weights=ranks)/counts)[inverse], counts
+
+
+def mann_whitney(a, b):
+    # One-sided p-value for "b tends to be larger than a", using the normal
+    # approximation with tie and continuity corrections.
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    n1, n2 = len(a), len(b)
+    if n1 < 2 or n2 < 2:
+        return np.nan
+    ranks, counts = _ranks(np.concatenate([a, b]))
+    u = ranks[n1:].sum() - n2*(n2 + 1)/2
+    n = n1 + n2
+    ties = (counts**3 - counts).sum()
+    sigma = math.sqrt(n1*n2/12.0*((n + 1) - ties/(n*(n - 1))))
+    if sigma == 0:
+        return 0.5
+    z = (u - n1*n2/2.0 - 0.5)/sigma
+    return 0.5*math.erfc(z/math.sqrt(2))
+
+
+def change_point(x, min_size=2):
+    # The split of a sequence (e.g., per-commit medians) that best separates
+    # it into two means: returns (index of the first element after the
+    # change, t-like score), or (None, 0.0) if it's too short to split.
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    if n < 2*min_size:
+        return None, 0.0
+    k = np.arange(min_size, n - min_size + 1)
+    c = np.cumsum(x)[k - 1]
+    left = c/k
+    right = (x.sum() - c)/(n - k)
+    std = x.std(ddof=1) or 1.0
+    score = np.abs(left - right)/(std*np.sqrt(1.0/k + 1.0/(n - k)))
+    best = int(np.argmax(score))
+    return int(k[best]), float(score[best])
+
+
+def detect_regressions(new, baseline, field="ET", by=None, alpha=0.01, min_change=0.03):
+    # One row per function/configuration present in both runs.  `change` is
+    # the relative change in the median of `field` (positive is slower).
+    if by is None:
+        by = [k for k in group_keys if k in new.columns and k in baseline.columns]
+    components = [c for c in ["IC", "CPI", "CT"] if c in new.columns and c in baseline.columns]
+
+    base_groups = {k if isinstance(k, tuple) else (k,): g for k, g in baseline.groupby(by, observed=True)}
+    rows = []
+    for key, g in new.groupby(by, observed=True):
+        key = key if isinstance(key, tuple) else (key,)
+        b = base_groups.get(key)
+        if b is None:
+            continue
+        base_median = b[field].median()
+        new_median = g[field].median()
+        change = new_median/base_median - 1
+        p_slower = mann_whitney(b[field], g[field])
+        p_faster = mann_whitney(g[field], b[field])
+        r = dict(zip(by, key))
+        r.update(label=" ".join(str(k) for k in key),
+                 base_reps=len(b), new_reps=len(g),
+                 **{f"base_{field}": base_median, f"new_{field}": new_median},
+                 ratio=new_median/base_median, change=change, p_slower=p_slower, p_faster=p_faster,
+                 p_value=min(p_slower, p_faster),
+                 regression=bool(p_slower < alpha and change > min_change),
+                 improvement=bool(p_faster < alpha and change < -min_change))
+
+        # Attribute the change to IC, CPI and CT.
+        total = math.log(new_median/base_median) if new_median > 0 and base_median > 0 else 0.0
+        logs = {}
+        for c in components:
+            bm, nm = b[c].median(), g[c].median()
+            r[f"{c}_change"] = nm/bm - 1 if bm else np.nan
+            logs[c] = math.log(nm/bm) if bm > 0 and nm > 0 else 0.0
+        for c in components:
+            r[f"{c}_share"] = logs[c]/total if total else np.nan
+        same_way = {c: v for c, v in logs.items() if v*total > 0}
+        r['cause'] = max(same_way, key=lambda c: abs(same_way[c])) if same_way and (r['regression'] or r['improvement']) else None
+        rows.append(r)
+    if not rows:
+        # Nothing in common.  Still return the columns callers look at.
+        columns = by + ["label", "base_reps", "new_reps", f"base_{field}", f"new_{field}", "ratio", "change", "p_slower", "p_faster",
+                        "p_value", "regression", "improvement"] + [f"{c}_{k}" for k in ("change", "share") for c in components] + ["cause"]
+        return pd.DataFrame(columns=columns).astype({"regression": bool, "improvement": bool})
+    return pd.DataFrame(rows)
+
+
+def compare_runs(db=None, new_run="latest", baseline_run=None, **kwargs):
+    # detect_regressions() between two runs in the results store.  With no
+    # baseline_run, the run before new_run is used.
+    import results_db
+    new = results_db.query(db, run=new_run)
+    if new.empty:
+        raise ValueError(f"No results for run {new_run}")
+    if baseline_run is None:
+        runs = results_db.runs(db)
+        earlier = runs[runs['run_id'] < new['run_id'].iloc[0]]
+        if earlier.empty:
+            raise ValueError("There's no earlier run to compare against.")
+        baseline_run = int(earlier['run_id'].iloc[-1])
+    return detect_regressions(new, results_db.query(db, run=baseline_run), **kwargs)
+
+
+def find_change(db=None, field="ET", **filters):
+    # Where in the history of the results store did `field` shift?  filters
+    # should pick out a single function/configuration, e.g.
+    # find_change(function="join_solution_c", customers=2048, products=4096, brands=64).
+    # Returns the per-run medians and the first run after the change.
+    import results_db
+    df = results_db.query(db, **filters)
+    if df.empty:
+        raise ValueError(f"No results for {filters}")
+    if 'git_hash' not in df.columns:
+        df['git_hash'] = None
+    history = df.groupby("run_id").agg(git_hash=("git_hash", "first"), median=(field, "median")).reset_index()
+    i, score = change_point(history['median'])
+    history.attrs['change'] = None if i is None else history.iloc[i].to_dict()
+    history.attrs['score'] = score
+    return history
+
+
+@click.command()
+@click.option("--baseline", required=True, type=click.Path(exists=True, dir_okay=False), help="CSV of baseline reps")
+@click.option("--new", "new_file", required=True, type=click.Path(exists=True, dir_okay=False), help="CSV of new reps")
+@click.option("--field", default="ET", help="Column to compare")
+@click.option("--alpha", default=0.01, help="Significance level")
+@click.option("--min-change", default=0.03, help="Smallest relative change worth reporting")
+def main(baseline=None, new_file=None, field=None, alpha=None, min_change=None):
+    r = detect_regressions(pd.read_csv(new_file), pd.read_csv(baseline), field=field, alpha=alpha, min_change=min_change)
+    if r.empty:
+        print("No common configurations between the new run and the baseline.")
+        return
+    for row in r.to_dict("records"):
+        status = "REGRESSION" if row['regression'] else "improvement" if row['improvement'] else "no change"
+        cause = f" (mostly {row['cause']})" if row['cause'] else ""
+        print(f"{row['label']}: {row['change']*100:+.1f}% {field}, p={row['p_value']:.3g}: {status}{cause}")
+    if r['regression'].any():
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+# A local SQLite store of benchmark results, so runs can be compared over
+# time without hunting for old CSV files.
+#
+# Every ingested CSV becomes a row in `runs` (where it came from and on what:
+# git hash, compiler flags, CPU MHz, host) and its rows go in `results`,
+# tagged with the run_id.  `results` grows a column the first time a CSV has
+# one it hasn't seen.
+#
+# The run paths in notebook.py and autograde.py call record() on what they
+# write, with the metadata they captured when the run started.  Set
+# RESULTS_DB_RECORD=0 to turn that off.
+
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import time
+import pandas as pd
+
+default_db = os.environ.get("RESULTS_DB", "results.sqlite")
+auto_record = os.environ.get("RESULTS_DB_RECORD", "1") not in ("", "0")
+
+key_columns = ["function", "size", "customers", "products", "brands"]
+
+_schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    source TEXT,
+    source_mtime REAL,
+    ingested REAL,
+    git_hash TEXT,
+    compiler_flags TEXT,
+    cpu_mhz REAL,
+    host TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_source ON runs (source, source_mtime);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER REFERENCES runs(run_id),
+    function TEXT,
+    size INTEGER,
+    customers INTEGER,
+    products INTEGER,
+    brands INTEGER
+);
+CREATE INDEX IF NOT EXISTS results_key ON results (function, size, customers, products, brands);
+CREATE INDEX IF NOT EXISTS results_run ON results (run_id);
+"""
+
+
+def connect(db=None):
+    # Concurrent autograde workers write to the same store, so wait for locks.
+    con = sqlite3.connect(db or default_db, timeout=60)
+    con.executescript(_schema)
+    return con
+
+
+def git_hash(dir=None):
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=dir or None, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compiler_flags(config="config.make"):
+    # The variable assignments in config.make, e.g. {"C_OPTS": "-O4"}.
+    flags = {}
+    try:
+        with open(config) as f:
+            for l in f:
+                l = l.split("#")[0].strip()
+                for op in ("?=", "+=", ":=", "="):
+                    if op in l:
+                        k, v = l.split(op, 1)
+                        flags[k.strip()] = v.strip()
+                        break
+    except OSError:
+        pass
+    return flags
+
+
+def cpu_mhz():
+    try:
+        with open("/proc/cpuinfo") as f:
+            mhz = [float(l.split(":")[1]) for l in f if l.startswith("cpu MHz")]
+        return sum(mhz)/len(mhz) if mhz else None
+    except (OSError, ValueError):
+        return None
+
+
+def run_metadata(dir=None):
+    # What ingest() stores about the code and machine, as of now.  Capture it
+    # when a run starts and pass it to ingest() or record() afterwards, so
+    # edits made while it runs don't get attributed to it.  dir is the
+    # checkout the run is built from.
+    return dict(git_hash=git_hash(dir), compiler_flags=compiler_flags(os.path.join(dir or "", "config.make")), cpu_mhz=cpu_mhz())
+
+
+def _add_columns(con, df):
+    existing = {r[1] for r in con.execute("PRAGMA table_info(results)")}
+    for c in df.columns:
+        if c not in existing:
+            kind = "REAL" if pd.api.types.is_float_dtype(df[c]) else "INTEGER" if pd.api.types.is_integer_dtype(df[c]) else "TEXT"
+            con.execute(f'ALTER TABLE results ADD COLUMN "{c}" {kind}')
+
+
+def ingest(file, db=None, force=False, git_hash=None, compiler_flags=None, cpu_mhz=None, **extra):
+    # Add a CSV of results to the store.  Re-ingesting an unchanged file is a
+    # no-op unless force=True.  Returns the run_id.  git_hash, compiler_flags
+    # (a dict) and cpu_mhz describe what produced the file (see
+    # run_metadata()); for an old file, pass what it was run with.  Any that
+    # are missing are taken from the current state.  `extra` is stored with
+    # the run as JSON (e.g., submission="...", notes="...").
+    given = dict(git_hash=git_hash, compiler_flags=compiler_flags, cpu_mhz=cpu_mhz)
+    if any(v is None for v in given.values()):
+        now = run_metadata()
+        given = {k: now[k] if v is None else v for k, v in given.items()}
+    source = os.path.abspath(file)
+    mtime = os.stat(file).st_mtime
+    con = connect(db)
+    try:
+        if not force:
+            r = con.execute("SELECT run_id FROM runs WHERE source = ? AND source_mtime = ?", (source, mtime)).fetchone()
+            if r:
+                return r[0]
+
+        df = pd.read_csv(file, sep=",")
+        for c in df.columns:
+            if not pd.api.types.is_numeric_dtype(df[c]):
+                df[c] = df[c].astype(str)
+        with con:
+            cur = con.execute("INSERT INTO runs (source, source_mtime, ingested, git_hash, compiler_flags, cpu_mhz, host, extra) "
+                              "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (source, mtime, time.time(), given['git_hash'], json.dumps(given['compiler_flags']), given['cpu_mhz'],
+                               socket.gethostname(), json.dumps(extra)))
+            run_id = cur.lastrowid
+            df.insert(0, "run_id", run_id)
+            _add_columns(con, df)
+            df.to_sql("results", con, if_exists="append", index=False)
+        return run_id
+    finally:
+        con.close()
+
+
+def record(file, metadata=None, db=None, **extra):
+    # ingest() for the run paths: does nothing unless auto_record is on, and
+    # a problem with the store is reported rather than failing the run.
+    # metadata is from run_metadata().  Returns the run_id or None.
+    if not auto_record:
+        return None
+    try:
+        return ingest(file, db=db, **(metadata or {}), **extra)
+    except (OSError, sqlite3.Error, pd.errors.ParserError) as e:
+        print(f"Couldn't record {file} in the results store: {e}")
+        return None
+
+
+def query(db=None, run=None, source=None, where=None, params=(), **filters):
+    # Results (with their run's metadata) as a DataFrame.  `filters` match
+    # columns exactly (a list matches any of its values), e.g.
+    # query(function="join_solution_c", customers=[2048, 4096]).  run is a
+    # run_id, a list of them, or "latest" for the most recent run with
+    # matching rows.  source is a SQL LIKE pattern on the CSV path.  where is
+    # extra SQL with `params`.
+    clauses, args = [], []
+    for k, v in filters.items():
+        if isinstance(v, (list, tuple, set)):
+            clauses.append(f'r."{k}" IN ({",".join("?"*len(v))})')
+            args += list(v)
+        else:
+            clauses.append(f'r."{k}" = ?')
+            args.append(v)
+    if source is not None:
+        clauses.append("u.source LIKE ?")
+        args.append(source)
+    if where:
+        clauses.append(f"({where})")
+        args += list(params)
+    if run == "latest":
+        w = " AND ".join(clauses) or "1"
+        clauses.append(f"r.run_id = (SELECT MAX(r.run_id) FROM results r JOIN runs u USING (run_id) WHERE {w})")
+        args += list(args)
+    elif isinstance(run, (list, tuple, set)):
+        clauses.append(f'r.run_id IN ({",".join("?"*len(run))})')
+        args += list(run)
+    elif run is not None:
+        clauses.append("r.run_id = ?")
+        args.append(run)
+
+    sql = ("SELECT r.*, u.source, u.ingested, u.git_hash, u.compiler_flags, u.cpu_mhz, u.host, u.extra "
+           "FROM results r JOIN runs u USING (run_id)")
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    con = connect(db)
+    try:
+        df = pd.read_sql_query(sql, con, params=args)
+    finally:
+        con.close()
+    # Drop the columns that only other kinds of runs have.
+    return df.dropna(axis=1, how="all")
+
+
+def runs(db=None):
+    con = connect(db)
+    try:
+        return pd.read_sql_query("SELECT * FROM runs ORDER BY run_id", con)
+    finally:
+        con.close()
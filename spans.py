@@ -0,0 +1,138 @@
+# Opt-in timing of the stages inside the Python tooling (code generation,
+# compilation, running commands, CSV parsing, rendering, scoring...), so a
+# slow notebook cell can be pinned on the compiler, the benchmark or pandas.
+#
+#   import spans
+#   with spans.profiling():
+#       fiddle(...)
+#       render_csv(...)
+#   spans.summary()                       # per-stage totals as a DataFrame
+#   spans.chrome_trace("trace.json")      # open in chrome://tracing or Perfetto
+#
+# Mark a stage with `with span("name"):` or decorate a function with
+# @timed("name").  When profiling is off (the default, unless FIDDLE_PROFILE=1)
+# both cost one global check.
+
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+enabled = os.environ.get("FIDDLE_PROFILE", "") not in ("", "0")
+
+# (name, start, end, self seconds, depth, thread id, args), times from perf_counter().
+_events = []
+_lock = threading.Lock()
+_current = contextvars.ContextVar("span", default=None)
+_off = nullcontext()
+
+
+class _Span:
+    __slots__ = ("name", "args", "start", "children", "parent", "depth", "token")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.children = 0.0
+
+    def __enter__(self):
+        # A context variable rather than a thread-local stack, so spans in
+        # concurrent asyncio tasks (e.g., run_commands()) nest properly.
+        self.parent = _current.get()
+        self.depth = 0 if self.parent is None else self.parent.depth + 1
+        self.token = _current.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        _current.reset(self.token)
+        elapsed = end - self.start
+        if self.parent is not None:
+            self.parent.children += elapsed
+        with _lock:
+            _events.append((self.name, self.start, end, max(elapsed - self.children, 0.0), self.depth, threading.get_ident(), self.args))
+        return False
+
+
+def span(name, **args):
+    # A context manager that records how long its body takes as stage `name`.
+    # `args` are shown with the event in the Chrome trace.
+    if not enabled:
+        return _off
+    return _Span(name, args)
+
+
+def timed(name=None):
+    # Decorator version of span(); the stage defaults to the function's name.
+    def decorate(f):
+        stage = name or f.__qualname__
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return f(*args, **kwargs)
+            with _Span(stage, {}):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def reset():
+    with _lock:
+        del _events[:]
+
+
+@contextmanager
+def profiling(clear=True):
+    # Record spans inside the block (dropping earlier ones unless clear=False).
+    global enabled
+    was = enabled
+    if clear:
+        reset()
+    enabled = True
+    try:
+        yield
+    finally:
+        enabled = was
+
+
+def events():
+    # One row per recorded span.
+    import pandas as pd
+    with _lock:
+        rows = list(_events)
+    origin = min((r[1] for r in rows), default=0.0)
+    return pd.DataFrame([dict(stage=n, start=s - origin, seconds=e - s, self_seconds=own, depth=d, thread=t, args=a)
+                         for n, s, e, own, d, t, a in rows],
+                        columns=["stage", "start", "seconds", "self_seconds", "depth", "thread", "args"])
+
+
+def summary():
+    # Aggregated per-stage timings, slowest first.  self_seconds excludes
+    # time spent in nested spans.
+    df = events()
+    s = df.groupby("stage").agg(count=("seconds", "size"), seconds=("seconds", "sum"), self_seconds=("self_seconds", "sum"),
+                                mean=("seconds", "mean"), max=("seconds", "max"))
+    return s.sort_values("seconds", ascending=False)
+
+
+def chrome_trace(file=None):
+    # The spans in Chrome's trace event format.  Written to `file` if given.
+    with _lock:
+        rows = list(_events)
+    trace = dict(traceEvents=[dict(name=n, cat="fiddle", ph="X", ts=s*1e6, dur=(e - s)*1e6, pid=os.getpid(), tid=t,
+                                   args={k: str(v) for k, v in a.items()})
+                              for n, s, e, _, _, t, a in rows],
+                 displayTimeUnit="ms")
+    if file is not None:
+        with open(file, "w") as f:
+            json.dump(trace, f)
+    return trace
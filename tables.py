@@ -0,0 +1,186 @@
+# Synthetic `order` and `product` tables (see table_struct.h) for the join
+# benchmark, and a vectorized reference join to check results against.
+#
+# The tables are NumPy structured arrays with exactly the C layouts, so
+# they can be written to a raw binary file and mmap()ed as an `order *` or
+# `product *` without conversion:
+#
+#   orders, products = generate("data/big", orders=10**8, customers=2048, products=4096, brands=64,
+#                               customer_skew=1.1)
+#   orders, products = load("data/big")     # later, memory-mapped
+#
+# Customer and product ids can follow a Zipf distribution (skew > 0) to
+# mimic popular products and heavy buyers.  Tables are generated in chunks,
+# straight into the output file, so 10^8 orders (2.4GB) doesn't need the
+# memory for them twice.
+
+import json
+import os
+import numpy as np
+
+order_dtype = np.dtype([("customer_id", "<u8"), ("product_id", "<u8"), ("quantity", "<u8")])
+product_dtype = np.dtype([("product_id", "<u8"), ("brand", "<u8"), ("price", "<u8")])
+joined_dtype = np.dtype([("customer_id", "<u8"), ("product_id", "<u8"), ("quantity", "<u8"), ("brand", "<u8"), ("price", "<u8")])
+
+# What `make autograde` runs join.exe with.
+default_config = dict(customers=2048, products=4096, brands=64)
+orders_per_customer = 4
+
+chunk_rows = 1 << 22
+
+
+class _Sampler:
+    # Draws ids in [0, n): uniformly for skew 0, otherwise Zipf, i.e.,
+    # P(rank k) ~ 1/k^skew.  Ranks map to ids through a random permutation so
+    # the popular ids aren't just the small ones.
+    def __init__(self, n, skew, rng):
+        self.n = n
+        self.rng = rng
+        if skew:
+            w = 1.0/np.arange(1, n + 1, dtype=np.float64)**skew
+            self.cdf = np.cumsum(w)
+            self.cdf /= self.cdf[-1]
+            self.ids = rng.permutation(n).astype(np.uint64)
+        else:
+            self.cdf = None
+
+    def __call__(self, size):
+        if self.cdf is None:
+            return self.rng.integers(0, self.n, size=size, dtype=np.uint64)
+        ranks = np.searchsorted(self.cdf, self.rng.random(size), side="right")
+        return self.ids[np.minimum(ranks, self.n - 1)]
+
+
+def _output(rows, dtype, path):
+    if path is None:
+        return np.empty(rows, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="w+", shape=(rows,))
+
+
+def make_products(products, brands, brand_skew=0.0, max_price=1000, seed=0, path=None):
+    # product_id i is row i.  Prices are uniform in [1, max_price].
+    rng = np.random.default_rng([seed, 1])
+    t = _output(products, product_dtype, path)
+    brand = _Sampler(brands, brand_skew, rng)
+    for s in range(0, products, chunk_rows):
+        e = min(s + chunk_rows, products)
+        t['product_id'][s:e] = np.arange(s, e, dtype=np.uint64)
+        t['brand'][s:e] = brand(e - s)
+        t['price'][s:e] = rng.integers(1, max_price + 1, size=e - s, dtype=np.uint64)
+    return t
+
+
+def make_orders(orders, customers, products, customer_skew=0.0, product_skew=0.0, max_quantity=10, seed=0, path=None):
+    # Quantities are uniform in [1, max_quantity].
+    rng = np.random.default_rng([seed, 0])
+    t = _output(orders, order_dtype, path)
+    customer = _Sampler(customers, customer_skew, rng)
+    product = _Sampler(products, product_skew, rng)
+    for s in range(0, orders, chunk_rows):
+        e = min(s + chunk_rows, orders)
+        t['customer_id'][s:e] = customer(e - s)
+        t['product_id'][s:e] = product(e - s)
+        t['quantity'][s:e] = rng.integers(1, max_quantity + 1, size=e - s, dtype=np.uint64)
+    return t
+
+
+def generate(path=None, orders=None, customers=None, products=None, brands=None,
+             customer_skew=0.0, product_skew=0.0, brand_skew=0.0, seed=0):
+    # Both tables, with unspecified sizes from default_config (orders
+    # defaults to orders_per_customer per customer).  With a path, they're written to
+    # {path}.orders.bin and {path}.products.bin (raw structs, native
+    # little-endian) plus {path}.json describing them, and the returned
+    # arrays are memory maps of those files.
+    config = dict(default_config)
+    config.update({k: v for k, v in dict(customers=customers, products=products, brands=brands).items() if v is not None})
+    config['orders'] = orders if orders is not None else orders_per_customer*config['customers']
+    config.update(customer_skew=customer_skew, product_skew=product_skew, brand_skew=brand_skew, seed=seed)
+
+    if path is not None:
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+    o = make_orders(config['orders'], config['customers'], config['products'], customer_skew=customer_skew,
+                    product_skew=product_skew, seed=seed, path=path and f"{path}.orders.bin")
+    p = make_products(config['products'], config['brands'], brand_skew=brand_skew, seed=seed,
+                      path=path and f"{path}.products.bin")
+    if path is not None:
+        o.flush()
+        p.flush()
+        with open(f"{path}.json", "w") as f:
+            json.dump(config, f, indent=2)
+    return o, p
+
+
+def load(path, mode="r"):
+    # The tables generate() wrote to path, memory-mapped.
+    return (np.memmap(f"{path}.orders.bin", dtype=order_dtype, mode=mode),
+            np.memmap(f"{path}.products.bin", dtype=product_dtype, mode=mode))
+
+
+def load_config(path):
+    with open(f"{path}.json") as f:
+        return json.load(f)
+
+
+def _join_chunks(orders, products, chunk=chunk_rows):
+    # reference_join(), `chunk` orders at a time.
+    if len(products) == 0:
+        return
+    order_by_id = np.argsort(products['product_id'], kind="stable")
+    ids = products['product_id'][order_by_id]
+    for s in range(0, len(orders), chunk):
+        o = orders[s:s + chunk]
+        i = np.minimum(np.searchsorted(ids, o['product_id']), len(ids) - 1)
+        found = ids[i] == o['product_id']
+        o, match = o[found], products[order_by_id[i[found]]]
+        j = np.empty(len(o), dtype=joined_dtype)
+        for f in order_dtype.names:
+            j[f] = o[f]
+        j['brand'] = match['brand']
+        j['price'] = match['price']
+        yield j
+
+
+def reference_join(orders, products, chunk=chunk_rows):
+    # orders JOIN products USING (product_id), in order-table order, as a
+    # joined_dtype array.  Orders for products that don't exist are dropped.
+    parts = list(_join_chunks(orders, products, chunk))
+    return np.concatenate(parts) if parts else np.empty(0, dtype=joined_dtype)
+
+
+def reference_totals(orders, products, by="customer_id", chunk=chunk_rows):
+    # Total spend (sum of quantity*price) per `by` (a column of the join, or a
+    # list of them), as a pandas Series.  Exact: sums are in uint64.  The join
+    # is aggregated a chunk at a time, so it never has to fit in memory.
+    import pandas as pd
+    by = [by] if isinstance(by, str) else list(by)
+    partial = []
+    for j in _join_chunks(orders, products, chunk):
+        df = pd.DataFrame({c: j[c] for c in by})
+        df['spend'] = j['quantity']*j['price']
+        partial.append(df.groupby(by)['spend'].sum())
+    if not partial:
+        empty = pd.DataFrame({c: np.empty(0, dtype=np.uint64) for c in by + ['spend']})
+        return empty.groupby(by)['spend'].sum()
+    return pd.concat(partial).groupby(level=by).sum() if len(partial) > 1 else partial[0]
+
+
+if __name__ == "__main__":
+    import click
+
+    @click.command()
+    @click.option("--path", required=True, help="Output prefix: writes PATH.orders.bin, PATH.products.bin and PATH.json")
+    @click.option("--orders", type=int, default=None, help=f"Number of orders (default: {orders_per_customer} per customer)")
+    @click.option("--customers", type=int, default=default_config['customers'])
+    @click.option("--products", type=int, default=default_config['products'])
+    @click.option("--brands", type=int, default=default_config['brands'])
+    @click.option("--customer-skew", type=float, default=0.0, help="Zipf exponent for customer ids (0 is uniform)")
+    @click.option("--product-skew", type=float, default=0.0, help="Zipf exponent for product ids (0 is uniform)")
+    @click.option("--brand-skew", type=float, default=0.0, help="Zipf exponent for brands (0 is uniform)")
+    @click.option("--seed", type=int, default=0)
+    def main(**kwargs):
+        o, p = generate(**kwargs)
+        print(f"Wrote {len(o)} orders and {len(p)} products to {kwargs['path']}.*")
+
+    main()
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+from click.testing import CliRunner
+
+import regressions
+
+
+def _run(function, et, reps=10, seed=0):
+    rng = np.random.default_rng(seed)
+    ic = np.full(reps, 1e6)
+    cpi = rng.normal(1.0, 0.005, reps)
+    ct = np.full(reps, 1/3.3e9)
+    return pd.DataFrame(dict(function=function, size=1, IC=ic, CPI=cpi*et, CT=ct, ET=ic*cpi*et*ct))
+
+
+def test_mann_whitney():
+    rng = np.random.default_rng(0)
+    a = rng.normal(1.0, 0.01, 20)
+    b = rng.normal(1.1, 0.01, 20)
+    assert regressions.mann_whitney(a, b) < 1e-6
+    assert regressions.mann_whitney(b, a) > 0.99
+    assert regressions.mann_whitney([1, 1, 1], [1, 1, 1]) == 0.5
+
+
+def test_detect_regression():
+    r = regressions.detect_regressions(_run("f", 1.2, seed=1), _run("f", 1.0))
+    assert r['regression'].all()
+    assert r['cause'].tolist() == ["CPI"]
+
+
+def test_no_common_configurations(tmp_path):
+    r = regressions.detect_regressions(_run("new", 1.0), _run("old", 1.0))
+    assert r.empty
+    assert {"regression", "improvement", "ratio", "change", "p_value"} <= set(r.columns)
+    assert not r['regression'].any()
+
+    _run("new", 1.0).to_csv(tmp_path/"new.csv", index=False)
+    _run("old", 1.0).to_csv(tmp_path/"old.csv", index=False)
+    result = CliRunner().invoke(regressions.main, ["--baseline", str(tmp_path/"old.csv"), "--new", str(tmp_path/"new.csv")])
+    assert result.exit_code == 0
+    assert "No common configurations" in result.output
@@ -0,0 +1,296 @@
+# Reuse-distance analysis of memory traces (the {name}_0.hdf5 files that
+# fiddle's mtrace option produces).
+#
+# The trace is read a chunk at a time.  Between chunks, all we keep is the LRU
+# stack (each distinct block once, least- to most-recently used, optionally cut
+# off at max_depth) and the sorted set of blocks we've seen.  Prepending the
+# stack to the next chunk gives a short trace with exactly the same reuse
+# distances as the full one, so each chunk can be solved on its own.
+#
+# Within a chunk, the reuse distance of the access at t to a block last
+# touched at p is the number of distinct blocks in (p, t): the positions in
+# (p, t) that are still the last access to their block at time t.  The
+# classic way to count them sweeps t with a Fenwick tree over last-access
+# positions.  The positions that have stopped being last accesses by time t
+# are exactly prev(u) for the accesses u < t, so the count is t - p - 1 -
+# #{u < t : prev(u) > p}, and that is done for all t at once, a level of the
+# tree at a time: O(n log n) work, all of it in NumPy.
+
+from collections import namedtuple
+import itertools
+import numpy as np
+import pandas as pd
+
+layers = ["misses-compulsory-all", "misses-capacity-all", "hits-all"]
+
+TraceAnalysis = namedtuple("TraceAnalysis", "accesses histogram classification")
+
+
+def read_trace(path, dataset=None, field=None, chunk=1<<20):
+    # Yield the addresses in an HDF5 trace, `chunk` at a time.  By default
+    # this uses the first dataset in the file and, if it has named fields,
+    # the first of "address", "addr", or "ptr" it finds.
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("Reading memory traces needs h5py (pip install h5py).")
+
+    with h5py.File(path, "r") as f:
+        if dataset is None:
+            names = []
+            f.visititems(lambda name, obj: names.append(name) if isinstance(obj, h5py.Dataset) else None)
+            if not names:
+                raise ValueError(f"{path} doesn't contain any datasets.")
+            dataset = names[0]
+        ds = f[dataset]
+        if field is None and ds.dtype.names:
+            field = next((n for n in ("address", "addr", "ptr") if n in ds.dtype.names), None)
+            if field is None:
+                raise ValueError(f"Don't know which field of {dataset} {ds.dtype.names} holds addresses.  Pass field=...")
+        for i in range(0, len(ds), chunk):
+            data = ds[i:i + chunk]
+            if field is not None:
+                data = data[field]
+            yield np.asarray(data).astype(np.uint64, copy=False)
+
+
+def _prev_next(b):
+    # Index of the previous/next access to the same block (-1/len(b) if none).
+    n = len(b)
+    order = np.argsort(b, kind="stable")
+    sb = b[order]
+    same = sb[1:] == sb[:-1]
+    prev = np.full(n, -1, dtype=np.int64)
+    nxt = np.full(n, n, dtype=np.int64)
+    prev[order[1:][same]] = order[:-1][same]
+    nxt[order[:-1][same]] = order[1:][same]
+    return prev, nxt
+
+
+def _earlier_greater(values):
+    # For every i: #{j < i : values[j] > values[i]}, for values >= -1.
+    #
+    # This is what a Fenwick tree over the values would answer if we swept
+    # i in order, querying the count above values[i] and then inserting it.
+    # Instead, each level of the tree's ranges is done for every i at once:
+    # at level L, values[j] > values[i] first shows up as bit L when they
+    # agree above L and values[j] has the 1.  The values are kept grouped by
+    # their bits above L (the groups are contiguous and, within each, in
+    # order of i), so that's a count of 1s in [start of i's group, i).
+    # Going down a level splits every group into its 0s and then its 1s.
+    n = len(values)
+    int_type = np.int32 if n < 2**31 - 1 else np.int64
+    x = np.asarray(values).astype(int_type) + 1
+    index = np.arange(n, dtype=int_type)
+    start = np.zeros(n, dtype=int_type)  # Where each value's group starts.
+    count = np.zeros(n, dtype=int_type)
+    for L in reversed(range(max(int(x.max(initial=0)).bit_length(), 1))):
+        one = ((x >> L) & 1).astype(bool)
+        ones = np.zeros(n + 1, dtype=int_type)
+        np.cumsum(one, out=ones[1:])
+        ones_at_start = ones[start]
+        zero = ~one
+        count += np.where(zero, ones[:-1] - ones_at_start, 0)
+
+        zeros = n - ones[n]
+        start = np.where(one, zeros + ones_at_start, start - ones_at_start)
+        order = np.concatenate([np.flatnonzero(zero), np.flatnonzero(one)])
+        x, start, count, index = x[order], start[order], count[order], index[order]
+    result = np.empty(n, dtype=np.int64)
+    result[index] = count
+    return result
+
+
+def _distinct_between(prev):
+    # For every access t with a previous access p: the number of distinct
+    # blocks touched in (p, t).  That's what's left of the t - p - 1
+    # accesses in between once we drop the ones whose block is touched
+    # again before t: the j in (p, t) with next(j) = u < t, that is, the
+    # accesses u < t with prev(u) > p.
+    q = np.flatnonzero(prev >= 0)
+    return q, q - prev[q] - 1 - _earlier_greater(prev)[q]
+
+
+def reuse_distances(chunks, max_depth=None):
+    # For each chunk of block numbers, yield (distances, compulsory).
+    # distances[i] is the number of distinct blocks touched since the last
+    # access to chunk[i]'s block, or max_depth if that's at least max_depth.
+    # compulsory[i] is True for first-ever accesses (their distance is -1).
+    history = np.empty(0, dtype=np.int64)
+    seen = np.empty(0, dtype=np.int64)
+    for chunk in chunks:
+        chunk = np.asarray(chunk).astype(np.int64, copy=False)
+        combined = np.concatenate([history, chunk])
+        prev, nxt = _prev_next(combined)
+        q, d = _distinct_between(prev)
+
+        h = len(history)
+        distances = np.full(len(chunk), -1, dtype=np.int64)
+        keep = q >= h
+        distances[q[keep] - h] = d[keep]
+        compulsory = distances < 0
+        if max_depth is not None:
+            # Fell off the bottom of the stack we kept.
+            deep = compulsory & np.isin(chunk, seen)
+            distances[deep] = max_depth
+            compulsory &= ~deep
+            np.minimum(distances, max_depth, out=distances)
+            seen = np.union1d(seen, chunk)
+
+        history = combined[nxt == len(combined)]
+        if max_depth is not None:
+            history = history[-max_depth:]
+        yield distances, compulsory
+
+
+def _histogram_bins(distances):
+    # Power-of-two bins: 0, 1, 2-3, 4-7, ...
+    return np.floor(np.log2(distances + 1)).astype(np.int64)
+
+
+def analyze_trace(path, dataset=None, field=None, chunk=1<<20, line_size=64, page_size=4096,
+                  cache_lines=512, tlb_entries=64, max_depth=1<<20):
+    # Reuse-distance histograms for cache lines and pages, and the
+    # compulsory/capacity/hit breakdown for a fully associative LRU cache of
+    # cache_lines lines and a TLB of tlb_entries pages.
+    granularities = dict(line=(int(np.log2(line_size)), cache_lines),
+                         page=(int(np.log2(page_size)), tlb_entries))
+    hist = {g: np.zeros(0, dtype=np.int64) for g in granularities}
+    classes = {g: dict.fromkeys(layers, 0) for g in granularities}
+    accesses = 0
+
+    # One pass over the file: tee() hands each chunk to both granularities.
+    sources = itertools.tee(read_trace(path, dataset=dataset, field=field, chunk=chunk), len(granularities))
+    def blocks(src, shift):
+        for c in src:
+            yield c >> np.uint64(shift)
+    streams = [reuse_distances(blocks(src, shift), max_depth=max_depth)
+               for src, (shift, _) in zip(sources, granularities.values())]
+
+    for results in zip(*streams):
+        accesses += len(results[0][0])
+        for g, (distances, compulsory) in zip(granularities, results):
+            capacity = granularities[g][1]
+            reused = distances[~compulsory]
+            counts = np.bincount(_histogram_bins(reused))
+            if len(counts) > len(hist[g]):
+                counts[:len(hist[g])] += hist[g]
+                hist[g] = counts
+            else:
+                hist[g][:len(counts)] += counts
+            hits = int((reused < capacity).sum())
+            classes[g]["misses-compulsory-all"] += int(compulsory.sum())
+            classes[g]["hits-all"] += hits
+            classes[g]["misses-capacity-all"] += len(reused) - hits
+
+    rows = []
+    for g, counts in hist.items():
+        for b, c in enumerate(counts):
+            rows.append(dict(granularity=g, distance_min=(1 << b) - 1, distance_max=(1 << (b + 1)) - 2, count=int(c)))
+    histogram = pd.DataFrame(rows, columns=["granularity", "distance_min", "distance_max", "count"])
+    classification = pd.DataFrame([dict(granularity=g, capacity=granularities[g][1], **classes[g]) for g in granularities])
+    return TraceAnalysis(accesses=accesses, histogram=histogram, classification=classification)
+
+
+# Trace-driven cache and TLB simulation.
+#
+# In a set-associative LRU cache, an access hits iff fewer than `ways`
+# distinct blocks that map to the same set have been touched since the last
+# access to its block.  Stable-sorting the accesses by set puts each set's
+# accesses next to each other in time order, so the same distinct-count
+# machinery as above gives every hit/miss in a chunk at once.  Between chunks
+# each level only keeps the `ways` most recent blocks of every set.
+
+Level = namedtuple("Level", "name sets ways block_size")
+
+# Roughly a Skylake-class core.
+default_caches = [Level("L1", 64, 8, 64),       # 32KB
+                  Level("L2", 1024, 16, 64)]    # 1MB
+default_tlbs = [Level("TLB", 16, 4, 4096),      # 64-entry L1 dTLB
+                Level("STLB", 128, 12, 4096)]   # 1536-entry L2 TLB
+huge_page_tlbs = [Level("TLB", 8, 4, 2<<20),    # 32 entries for 2MB pages
+                  Level("STLB", 128, 12, 2<<20)]
+
+
+class SetAssociative:
+    def __init__(self, level):
+        self.level = level
+        self.shift = np.uint64(int(np.log2(level.block_size)))
+        self.history = np.empty(0, dtype=np.int64)
+
+    def access(self, addresses):
+        # Run a chunk of addresses through the cache.  Returns a hit mask.
+        sets, ways = self.level.sets, self.level.ways
+        combined = np.concatenate([self.history, (np.asarray(addresses, dtype=np.uint64) >> self.shift).astype(np.int64)])
+        order = np.argsort(combined % sets, kind="stable")
+        prev, nxt = _prev_next(combined[order])
+        q, d = _distinct_between(prev)
+        hit = np.zeros(len(combined), dtype=bool)
+        hit[order[q]] = d < ways
+
+        # Keep the `ways` most recently used blocks of each set, in time order.
+        last = np.zeros(len(combined), dtype=bool)
+        last[order[nxt == len(combined)]] = True
+        candidates = combined[last]
+        s = candidates % sets
+        o = np.argsort(s, kind="stable")
+        group_end = np.searchsorted(s[o], s[o], side="right")
+        keep = np.zeros(len(candidates), dtype=bool)
+        keep[o] = group_end - np.arange(len(o)) <= ways
+
+        h = len(self.history)
+        self.history = candidates[keep]
+        return hit[h:]
+
+
+def simulate(chunks, caches=None, tlbs=None, ic=None):
+    # Simulate a stream of address chunks through a cache hierarchy and a
+    # TLB hierarchy.  Each level only sees the misses of the one above it.
+    # Returns a dict of perfstats-style counts (IC defaults to the number of
+    # accesses, since the trace doesn't know about non-memory instructions).
+    if caches is None:
+        caches = default_caches
+    if tlbs is None:
+        tlbs = default_tlbs
+    hierarchies = [[SetAssociative(l) for l in caches], [SetAssociative(l) for l in tlbs]]
+    misses = {l.level.name: 0 for h in hierarchies for l in h}
+    accesses = 0
+
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=np.uint64)
+        accesses += len(chunk)
+        for hierarchy in hierarchies:
+            a = chunk
+            for l in hierarchy:
+                if len(a) == 0:
+                    break
+                a = a[~l.access(a)]
+                misses[l.level.name] += len(a)
+
+    if ic is None:
+        ic = accesses
+    r = dict(IC=ic, accesses=accesses)
+    for name, m in misses.items():
+        r[f"{name}_misses"] = m
+        r[f"{name}_MPI"] = m/ic if ic else np.nan
+    if caches:
+        first = caches[0].name
+        r["L1_cache_misses"] = r[f"{first}_misses"]
+        r["L1_MPI"] = r[f"{first}_MPI"]
+        r["L1_dcache_accesses"] = accesses
+        r["L1_dcache_misses"] = r[f"{first}_misses"]
+        r["L1_dcache_miss_rate"] = r[f"{first}_misses"]/accesses if accesses else np.nan
+    if tlbs:
+        first = tlbs[0].name
+        r["TLB_misses"] = r[f"{first}_misses"]
+        r["TLB_MPI"] = r[f"{first}_MPI"]
+    return r
+
+
+def simulate_trace(path, dataset=None, field=None, chunk=1<<20, caches=None, tlbs=None, ic=None, **columns):
+    # simulate() an HDF5 trace.  Returns a one-row DataFrame with the same
+    # counter columns as the stats CSVs, plus any `columns` you pass (e.g.,
+    # function="TLB_4096", size=...), so several runs can be concatenated and
+    # handed to plotPE/plotPEBar.
+    r = simulate(read_trace(path, dataset=dataset, field=field, chunk=chunk), caches=caches, tlbs=tlbs, ic=ic)
+    return pd.DataFrame([dict(columns, **r)])